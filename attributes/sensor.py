@@ -2,7 +2,14 @@
 # Creates a sensor that breaks out attribute of defined entities.
 # """
 import asyncio
+from collections import OrderedDict, deque
+from datetime import datetime
+import fnmatch
+import heapq
 import logging
+import math
+from numbers import Number
+import re
 
 import voluptuous as vol
 
@@ -10,66 +17,134 @@ from homeassistant.core import callback
 from homeassistant.components.sensor import ENTITY_ID_FORMAT, PLATFORM_SCHEMA
 from homeassistant.const import (
     ATTR_FRIENDLY_NAME, ATTR_UNIT_OF_MEASUREMENT,
-    ATTR_ICON, CONF_ENTITIES, EVENT_HOMEASSISTANT_START, STATE_UNKNOWN)
+    ATTR_ICON, CONF_ENTITIES, EVENT_STATE_CHANGED, MATCH_ALL,
+    STATE_UNAVAILABLE, STATE_UNKNOWN)
 from homeassistant.exceptions import TemplateError
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.entity import Entity, async_generate_entity_id
-from homeassistant.helpers.event import async_track_state_change
+from homeassistant.helpers.event import async_call_later
 from homeassistant.helpers.restore_state import RestoreEntity
 from homeassistant.helpers import template as template_helper
+from homeassistant.util import dt as dt_util, slugify
 
 __version__ = '1.0.0'
 
 _LOGGER = logging.getLogger(__name__)
 
+DATA_ATTRIBUTES = "attributes"
+DATA_TEMPLATES = "attributes_templates"
+DATA_STARTUP = "attributes_startup"
+DATA_CREATED = "attributes_created"
+
 CONF_ATTRIBUTE = "attribute"
 CONF_TIME_FORMAT = "time_format"
-
-PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
+CONF_VALUE_TEMPLATE = "value_template"
+CONF_ICON_TEMPLATE = "icon_template"
+CONF_DOMAINS = "domains"
+CONF_ENTITY_REGEX = "entity_regex"
+CONF_REQUIRE_ATTRIBUTE = "require_attribute"
+CONF_MIN_INTERVAL = "min_interval"
+CONF_AGGREGATES = "aggregates"
+CONF_THRESHOLD = "threshold"
+
+AGGREGATE_MIN = "min"
+AGGREGATE_MAX = "max"
+AGGREGATE_MEAN = "mean"
+AGGREGATE_COUNT_BELOW = "count_below"
+AGGREGATES = [AGGREGATE_MIN, AGGREGATE_MAX, AGGREGATE_MEAN,
+              AGGREGATE_COUNT_BELOW]
+
+# Characters making an entry of entities a glob pattern
+GLOB_CHARS = frozenset('*?[')
+
+# Number of distinct compiled templates kept for reuse
+TEMPLATE_CACHE_SIZE = 256
+
+# Number of sensors evaluated per event loop iteration at startup
+STARTUP_BATCH = 50
+
+TIME_ATTRIBUTES = ("last_triggered", "last_changed")
+BATTERY_ATTRIBUTES = ("battery", "battery_level")
+
+# Battery level above which the icon applies, highest first
+BATTERY_THRESHOLDS = [
+    (95, 'mdi:battery'),
+    (85, 'mdi:battery-90'),
+    (75, 'mdi:battery-80'),
+    (65, 'mdi:battery-70'),
+    (55, 'mdi:battery-60'),
+    (45, 'mdi:battery-50'),
+    (35, 'mdi:battery-40'),
+    (25, 'mdi:battery-30'),
+    (15, 'mdi:battery-20'),
+    (10, 'mdi:battery-10'),
+]
+
+
+def _battery_level_icon(level):
+    """Return the icon of a battery level."""
+    for threshold, icon in BATTERY_THRESHOLDS:
+        if level > threshold:
+            return icon
+    return 'mdi:battery-outline'
+
+
+# Icon of every whole battery level from 0 to 100
+BATTERY_ICONS = [_battery_level_icon(level) for level in range(101)]
+
+
+def entity_selectors(value):
+    """Validate entity IDs, allowing glob patterns such as sensor.*."""
+    selectors = []
+    for selector in cv.ensure_list_csv(value):
+        selector = cv.string(selector).strip().lower()
+        if not GLOB_CHARS.intersection(selector):
+            selector = cv.entity_id(selector)
+        selectors.append(selector)
+    return selectors
+
+
+PLATFORM_SCHEMA = vol.All(PLATFORM_SCHEMA.extend({
     vol.Optional(ATTR_ICON): cv.string,
     vol.Optional(ATTR_FRIENDLY_NAME): cv.string,
     vol.Optional(ATTR_UNIT_OF_MEASUREMENT): cv.string,
     vol.Optional(CONF_TIME_FORMAT): cv.string,
+    vol.Optional(CONF_VALUE_TEMPLATE): cv.string,
+    vol.Optional(CONF_ICON_TEMPLATE): cv.string,
+    vol.Optional(CONF_MIN_INTERVAL): cv.time_period,
+    vol.Optional(CONF_AGGREGATES):
+        vol.All(cv.ensure_list, [vol.In(AGGREGATES)]),
+    vol.Optional(CONF_THRESHOLD): vol.Coerce(float),
     vol.Required(CONF_ATTRIBUTE): cv.string,
-    vol.Required(CONF_ENTITIES): cv.entity_ids
-})
+    vol.Optional(CONF_ENTITIES): entity_selectors,
+    vol.Optional(CONF_DOMAINS): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional(CONF_ENTITY_REGEX): cv.is_regex,
+    vol.Optional(CONF_REQUIRE_ATTRIBUTE): cv.boolean,
+}), cv.has_at_least_one_key(
+    CONF_ENTITIES, CONF_DOMAINS, CONF_ENTITY_REGEX, CONF_REQUIRE_ATTRIBUTE))
 
 
 @asyncio.coroutine
 def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
     """Set up the attributes sensors."""
     _LOGGER.info("Starting attribute sensor")
-    sensors = []
-
-    for device in config[CONF_ENTITIES]:
-        attr = config.get(CONF_ATTRIBUTE)
-        time_format = str(config.get(CONF_TIME_FORMAT))
-
-        if (attr == "last_triggered" or
-                attr == "last_changed") and time_format:
-
-            state_template = ("{{% if states('{0}') != '{2}' %}}\
-                              {{{{ as_timestamp(states.{0}.attributes['{1}'])\
-                              | int | timestamp_local()\
-                              | timestamp_custom('{2}') }}}}\
-                              {{% else %}} {3} {{% endif %}}").format(
-                device, attr, time_format, STATE_UNKNOWN)
-        elif attr == "battery" or attr == "battery_level":
-            state_template = ("{{% if states('{0}') != '{2}' %}}\
-                              {{{{ states.{0}.attributes['{1}'] | float }}}}\
-                              {{% else %}} {2} {{% endif %}}").format(
-                device, attr, STATE_UNKNOWN)
-        else:
-            state_template = ("{{% if states('{0}') != '{2}' %}}\
-                              {{{{ states.{0}.attributes['{1}'] }}}}\
-                              {{% else %}} {2} {{% endif %}}").format(
-                device, attr, STATE_UNKNOWN)
+    attr = config.get(CONF_ATTRIBUTE)
+    accessor = attribute_accessor(attr, config.get(CONF_TIME_FORMAT))
+
+    try:
+        value_template = get_template(hass, config.get(CONF_VALUE_TEMPLATE))
+        icon_template = get_template(hass, config.get(CONF_ICON_TEMPLATE))
+    except TemplateError as ex:
+        _LOGGER.error("Invalid template: %s", ex)
+        return False
 
+    def make_sensor(device):
+        """Create the sensor of a source entity."""
         _LOGGER.info("Adding attribute: %s of entity: %s", attr, device)
-        _LOGGER.debug("Applying template: %s", state_template)
 
-        state_template = template_helper.Template(state_template)
-        state_template.hass = hass
+        device_accessor = accessor
+        if value_template is not None:
+            device_accessor = template_accessor(value_template, device, attr)
 
         icon = str(config.get(ATTR_ICON))
 
@@ -85,86 +160,596 @@ def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
         friendly_name = config.get(ATTR_FRIENDLY_NAME, device_friendly_name)
         unit_of_measurement = config.get(ATTR_UNIT_OF_MEASUREMENT)
 
-        if icon.startswith('mdi:'):
+        if icon_template is not None:
+            _LOGGER.debug("Applying user defined icon template")
+            icon = template_icon(icon_template, device, attr)
+        elif icon.startswith('mdi:'):
             _LOGGER.debug("Applying user defined icon: '%s'", icon)
-            new_icon = ("{{% if states('{0}') != '{2}' %}} {1} {{% else %}}\
-                mdi:eye {{% endif %}}").format(device, icon, STATE_UNKNOWN)
-
-            new_icon = template_helper.Template(new_icon)
-            new_icon.hass = hass
-        elif attr == "battery" or attr == "battery_level":
-            _LOGGER.debug("Applying battery icon template")
-
-            new_icon = ("{{% if states('{0}') != '{2}' %}}\
-                {{% set batt = states.{0}.attributes['{1}']|int %}}\
-                {{% if batt == 'unknown' %}}\
-                mdi:battery-unknown\
-                {{% elif batt > 95 %}}\
-                mdi:battery\
-                {{% elif batt > 85 %}}\
-                mdi:battery-90\
-                {{% elif batt > 75 %}}\
-                mdi:battery-80\
-                {{% elif batt > 65 %}}\
-                mdi:battery-70\
-                {{% elif batt > 55 %}}\
-                mdi:battery-60\
-                {{% elif batt > 45 %}}\
-                mdi:battery-50\
-                {{% elif batt > 35 %}}\
-                mdi:battery-40\
-                {{% elif batt > 25 %}}\
-                mdi:battery-30\
-                {{% elif batt > 15 %}}\
-                mdi:battery-20\
-                {{% elif batt > 10 %}}\
-                mdi:battery-10\
-                {{% else %}}\
-                mdi:battery-outline\
-                {{% endif %}}\
-            {{% else %}}\
-            mdi:battery-unknown\
-            {{% endif %}}").format(device, attr, STATE_UNKNOWN)
-            new_icon = template_helper.Template(str(new_icon))
-            new_icon.hass = hass
+            icon = user_icon(icon)
+        elif attr in BATTERY_ATTRIBUTES:
+            _LOGGER.debug("Applying battery icon")
+            icon = battery_icon
         else:
             _LOGGER.debug("No icon applied")
-            new_icon = None
-
-        sensors.append(
-            AttributeSensor(
-                hass,
-                ("{0}_{1}").format(device.split(".", 1)[1], attr),
-                friendly_name,
-                unit_of_measurement,
-                state_template,
-                new_icon,
-                device)
-        )
-    if not sensors:
+            icon = None
+
+        return AttributeSensor(
+            hass,
+            ("{0}_{1}").format(device.split(".", 1)[1], attr),
+            friendly_name,
+            unit_of_measurement,
+            attr,
+            device_accessor,
+            icon,
+            device,
+            config.get(CONF_MIN_INTERVAL))
+
+    selector = EntitySelector(
+        config.get(CONF_ENTITIES, []), config.get(CONF_DOMAINS, []),
+        config.get(CONF_ENTITY_REGEX),
+        attr if config.get(CONF_REQUIRE_ATTRIBUTE) else None,
+        get_created_entities(hass))
+
+    if config.get(CONF_AGGREGATES):
+        return async_setup_aggregates(hass, config, selector,
+                                      async_add_devices)
+
+    sensors = OrderedDict(
+        (device, make_sensor(device)) for device in selector.explicit)
+
+    if selector.dynamic:
+        for state in hass.states.async_all():
+            if (state.entity_id not in sensors and
+                    selector.matches(state.entity_id, state)):
+                sensors[state.entity_id] = make_sensor(state.entity_id)
+
+        @callback
+        def async_entity_changed(entity_id, old_state, new_state):
+            """Create or retire sensors as matching entities come and go."""
+            if new_state is None:
+                selector.forget(entity_id)
+                if entity_id in selector.explicit:
+                    return
+
+                sensor = sensors.pop(entity_id, None)
+                if sensor is not None:
+                    _LOGGER.info("Retiring attribute: %s of entity: %s",
+                                 attr, entity_id)
+                    hass.async_create_task(sensor.async_remove())
+            elif (entity_id not in sensors and
+                  selector.matches(entity_id, new_state)):
+                sensor = sensors[entity_id] = make_sensor(entity_id)
+                async_add_devices([sensor])
+
+        get_dispatcher(hass).async_track(MATCH_ALL, async_entity_changed)
+    elif not sensors:
         _LOGGER.error("No sensors added")
         return False
 
+    async_add_devices(list(sensors.values()))
+    return True
+
+
+@callback
+def async_setup_aggregates(hass, config, selector, async_add_devices):
+    """Set up sensors aggregating the attribute over the selection."""
+    attr = config.get(CONF_ATTRIBUTE)
+    threshold = config.get(CONF_THRESHOLD)
+    if (AGGREGATE_COUNT_BELOW in config[CONF_AGGREGATES] and
+            threshold is None):
+        _LOGGER.error("%s needs %s", AGGREGATE_COUNT_BELOW, CONF_THRESHOLD)
+        return False
+
+    group = AttributeGroup(threshold)
+    name = config.get(ATTR_FRIENDLY_NAME, attr)
+    unit_of_measurement = config.get(ATTR_UNIT_OF_MEASUREMENT)
+    sensors = [
+        AggregateSensor(
+            hass, "{0}_{1}".format(slugify(name), kind),
+            "{0} {1}".format(name, kind.replace('_', ' ')),
+            None if kind == AGGREGATE_COUNT_BELOW else unit_of_measurement,
+            kind, group)
+        for kind in config[CONF_AGGREGATES]]
+
+    def value(state):
+        """Return the attribute of a source state as number, if any."""
+        if state is None or state.state in (STATE_UNKNOWN, STATE_UNAVAILABLE):
+            return None
+        try:
+            number = float(state.attributes.get(attr))
+        except (TypeError, ValueError):
+            return None
+        return number if math.isfinite(number) else None
+
+    if selector.dynamic:
+        states = hass.states.async_all()
+    else:
+        states = [hass.states.get(entity) for entity in selector.explicit]
+    for state in states:
+        if state is not None and selector.matches(state.entity_id, state):
+            group.update(state.entity_id, value(state))
+
+    @callback
+    def async_entity_changed(entity_id, old_state, new_state):
+        """Update the group with the changed member."""
+        if new_state is None:
+            selector.forget(entity_id)
+            changed = group.update(entity_id, None)
+        elif selector.matches(entity_id, new_state):
+            changed = group.update(entity_id, value(new_state))
+        else:
+            # A member that stops matching, ie. loses the attribute under
+            # require_attribute, leaves the group
+            changed = group.update(entity_id, None)
+
+        if changed:
+            for sensor in sensors:
+                sensor.async_group_changed()
+
+    dispatcher = get_dispatcher(hass)
+    if selector.dynamic:
+        dispatcher.async_track(MATCH_ALL, async_entity_changed)
+    else:
+        for entity in selector.explicit:
+            dispatcher.async_track(entity, async_entity_changed)
+
     async_add_devices(sensors)
     return True
 
 
+class AttributeGroup(object):
+    """Numeric values of a group of entities, aggregated incrementally.
+
+    The sum and the count below threshold are kept up to date, minimum
+    and maximum come from heaps whose outdated entries are dropped when
+    they reach the top, so each change costs O(log n).
+    """
+
+    def __init__(self, threshold=None):
+        """Initialize the group."""
+        self.threshold = threshold
+        self._values = {}
+        self._sum = 0.0
+        self._below = 0
+        self._min_heap = []
+        self._max_heap = []
+
+    def __len__(self):
+        """Return the number of members with a value."""
+        return len(self._values)
+
+    def update(self, entity_id, value):
+        """Set the value of a member, None removes it.
+
+        Return True if the value changed.
+        """
+        old = self._values.get(entity_id)
+        if old == value:
+            return False
+
+        if old is not None:
+            del self._values[entity_id]
+            self._sum -= old
+            if self.threshold is not None and old < self.threshold:
+                self._below -= 1
+
+        if value is not None:
+            self._values[entity_id] = value
+            self._sum += value
+            if self.threshold is not None and value < self.threshold:
+                self._below += 1
+            heapq.heappush(self._min_heap, (value, entity_id))
+            heapq.heappush(self._max_heap, (-value, entity_id))
+
+        if len(self._min_heap) > 2 * len(self._values) + 16:
+            self._compact()
+        return True
+
+    def _compact(self):
+        """Rebuild the heaps from the current values only."""
+        self._min_heap = [(value, entity_id)
+                          for entity_id, value in self._values.items()]
+        self._max_heap = [(-value, entity_id)
+                          for entity_id, value in self._values.items()]
+        heapq.heapify(self._min_heap)
+        heapq.heapify(self._max_heap)
+        self._sum = math.fsum(self._values.values())
+
+    def _top(self, heap, sign):
+        """Return the current (value, entity_id) on top of a heap."""
+        while heap:
+            value, entity_id = heap[0]
+            if self._values.get(entity_id) == sign * value:
+                return sign * value, entity_id
+            heapq.heappop(heap)
+        return None, None
+
+    def minimum(self):
+        """Return the smallest value and its entity."""
+        return self._top(self._min_heap, 1)
+
+    def maximum(self):
+        """Return the largest value and its entity."""
+        return self._top(self._max_heap, -1)
+
+    def mean(self):
+        """Return the mean value, None if the group has no values."""
+        if not self._values:
+            return None
+        return self._sum / len(self._values)
+
+    def count_below(self):
+        """Return the number of values below the threshold."""
+        return self._below
+
+
+class EntitySelector(object):
+    """Entities picked by ID, glob pattern, domain, regex or attribute.
+
+    Whether an entity ID matches is decided once and remembered, so each
+    state change costs one lookup however many patterns are configured.
+    """
+
+    def __init__(self, entities, domains=(), regex=None, attribute=None,
+                 exclude=frozenset()):
+        """Initialize the selector."""
+        self.explicit = [entity for entity in entities
+                         if not GLOB_CHARS.intersection(entity)]
+        self._patterns = [re.compile(fnmatch.translate(entity))
+                          for entity in entities
+                          if GLOB_CHARS.intersection(entity)]
+        self._domains = set(domains)
+        self._regex = regex
+        self._everything = not (entities or domains or regex)
+        self._explicit = set(self.explicit)
+        self._attribute = attribute
+        self._exclude = exclude
+        self._matches = {}
+
+    @property
+    def dynamic(self):
+        """Return True if the selected entities can change over time."""
+        return bool(self._patterns or self._domains or
+                    self._regex is not None or self._attribute is not None)
+
+    def _matches_id(self, entity_id):
+        """Return True if the entity ID is selected, remembering it."""
+        if entity_id in self._exclude and entity_id not in self._explicit:
+            return False
+        matched = self._matches.get(entity_id)
+        if matched is None:
+            if self._everything:
+                matched = True
+            else:
+                matched = (
+                    entity_id in self._explicit or
+                    entity_id.split('.', 1)[0] in self._domains or
+                    any(pattern.match(entity_id)
+                        for pattern in self._patterns) or
+                    (self._regex is not None and
+                     self._regex.search(entity_id) is not None))
+            self._matches[entity_id] = matched
+        return matched
+
+    def matches(self, entity_id, state):
+        """Return True if the entity with this state is selected."""
+        if not self._matches_id(entity_id):
+            return False
+        if self._attribute is None:
+            return True
+        return state is not None and self._attribute in state.attributes
+
+    def forget(self, entity_id):
+        """Drop what is remembered about a removed entity."""
+        self._matches.pop(entity_id, None)
+
+
+class StateDispatcher(object):
+    """Route state changes to the sensors watching the changed entity.
+
+    One state changed listener serves all attribute sensors instead of
+    one per sensor.
+    """
+
+    def __init__(self, hass):
+        """Initialize the dispatcher."""
+        self.hass = hass
+        self._listeners = {}
+        self._unsub = None
+
+    @callback
+    def async_track(self, entity_id, action):
+        """Call action on state changes of entity_id, return remover.
+
+        MATCH_ALL as entity_id calls the action for every entity.
+        """
+        self._listeners.setdefault(entity_id, []).append(action)
+
+        if self._unsub is None:
+            self._unsub = self.hass.bus.async_listen(
+                EVENT_STATE_CHANGED, self._async_state_changed)
+
+        @callback
+        def remove():
+            """Stop calling the action."""
+            listeners = self._listeners.get(entity_id)
+            if listeners is None or action not in listeners:
+                return
+
+            listeners.remove(action)
+            if not listeners:
+                del self._listeners[entity_id]
+
+            if not self._listeners and self._unsub is not None:
+                self._unsub()
+                self._unsub = None
+
+        return remove
+
+    @callback
+    def _async_state_changed(self, event):
+        """Call the actions watching the changed entity or all entities."""
+        entity_id = event.data.get('entity_id')
+        listeners = self._listeners.get(entity_id, [])
+        listeners = listeners + self._listeners.get(MATCH_ALL, [])
+        if not listeners:
+            return
+
+        old_state = event.data.get('old_state')
+        new_state = event.data.get('new_state')
+        for action in listeners:
+            action(entity_id, old_state, new_state)
+
+
+def get_created_entities(hass):
+    """Return the set of entity IDs created by this platform."""
+    created = hass.data.get(DATA_CREATED)
+    if created is None:
+        created = hass.data[DATA_CREATED] = set()
+    return created
+
+
+def get_dispatcher(hass):
+    """Return the dispatcher shared by all attribute sensors."""
+    dispatcher = hass.data.get(DATA_ATTRIBUTES)
+    if dispatcher is None:
+        dispatcher = hass.data[DATA_ATTRIBUTES] = StateDispatcher(hass)
+    return dispatcher
+
+
+class StartupQueue(object):
+    """Spread the first evaluation of the sensors over the event loop.
+
+    At most batch sensors are evaluated before yielding to the loop, the
+    time until the queue drains is logged.
+    """
+
+    def __init__(self, hass, batch=STARTUP_BATCH):
+        """Initialize the queue."""
+        self.hass = hass
+        self.batch = batch
+        self._queue = deque()
+        self._handle = None
+        self._started = None
+        self._count = 0
+
+    @callback
+    def async_add(self, action):
+        """Call action in one of the next loop iterations."""
+        self._queue.append(action)
+        if self._handle is not None:
+            return
+
+        if self._started is None:
+            self._started = self.hass.loop.time()
+            self._count = 0
+        self._handle = self.hass.loop.call_soon(self._async_run)
+
+    @callback
+    def _async_run(self):
+        """Call a batch of actions, reschedule if more are waiting."""
+        self._handle = None
+        for _ in range(min(self.batch, len(self._queue))):
+            self._queue.popleft()()
+            self._count += 1
+
+        if self._queue:
+            self._handle = self.hass.loop.call_soon(self._async_run)
+            return
+
+        _LOGGER.info("Evaluated %d attribute sensors in %.3f s",
+                     self._count, self.hass.loop.time() - self._started)
+        self._started = None
+
+
+def get_startup_queue(hass):
+    """Return the startup queue shared by all attribute sensors."""
+    queue = hass.data.get(DATA_STARTUP)
+    if queue is None:
+        queue = hass.data[DATA_STARTUP] = StartupQueue(hass)
+    return queue
+
+
+class TemplateCache(object):
+    """Compiled templates shared by all sensors, keyed by their text.
+
+    The least recently used template is dropped when there are more
+    than size of them, sensors already using it keep their reference.
+    """
+
+    def __init__(self, hass, size=TEMPLATE_CACHE_SIZE):
+        """Initialize the cache."""
+        self.hass = hass
+        self.size = size
+        self._templates = OrderedDict()
+
+    def get(self, text):
+        """Return the compiled template of the text."""
+        template = self._templates.pop(text, None)
+
+        if template is None:
+            template = template_helper.Template(text, self.hass)
+            template.ensure_valid()
+
+        self._templates[text] = template
+        if len(self._templates) > self.size:
+            self._templates.popitem(last=False)
+
+        return template
+
+
+def get_template(hass, text):
+    """Return the shared compiled template of the text, if any."""
+    if text is None:
+        return None
+
+    cache = hass.data.get(DATA_TEMPLATES)
+    if cache is None:
+        cache = hass.data[DATA_TEMPLATES] = TemplateCache(hass)
+    return cache.get(text)
+
+
+def _render(template, variables):
+    """Render a template, logging errors."""
+    try:
+        return template.async_render(variables)
+    except TemplateError as ex:
+        _LOGGER.error('Could not render template for %s: %s',
+                      variables['entity'], ex)
+        return None
+
+
+def template_accessor(template, entity_id, attr):
+    """Return a function rendering the value template of a source."""
+    def access(state):
+        """Render the template unless the source is unknown."""
+        if state is None or state.state == STATE_UNKNOWN:
+            return STATE_UNKNOWN
+
+        return _render(template, {
+            'entity': entity_id,
+            'attribute': attr,
+            'value': state.attributes.get(attr),
+        })
+
+    return access
+
+
+def template_icon(template, entity_id, attr):
+    """Return a function rendering the icon template of a source."""
+    def get(value):
+        """Render the icon for the state."""
+        return _render(template, {
+            'entity': entity_id,
+            'attribute': attr,
+            'value': value,
+        })
+
+    return get
+
+
+def battery_icon(value):
+    """Return the icon of a battery level, unknown if not a number."""
+    try:
+        level = int(float(value))
+    except (OverflowError, TypeError, ValueError):
+        return 'mdi:battery-unknown'
+
+    return BATTERY_ICONS[min(max(level, 0), 100)]
+
+
+def user_icon(icon):
+    """Return a function showing the icon unless the state is unknown."""
+    def get(value):
+        """Return the icon for the state."""
+        return 'mdi:eye' if value == STATE_UNKNOWN else icon
+
+    return get
+
+
+def source_value(state, attr):
+    """Return the attribute of a source state.
+
+    Without a last_changed attribute the time the state last changed is
+    used instead.
+    """
+    value = state.attributes.get(attr)
+    if value is None and attr == 'last_changed':
+        return state.last_changed
+    return value
+
+
+def attribute_accessor(attr, time_format=None):
+    """Return a function reading the attribute from a source state."""
+    if attr in TIME_ATTRIBUTES and time_format:
+        def read(state):
+            """Read the time attribute formatted in local time."""
+            value = source_value(state, attr)
+            if isinstance(value, str):
+                value = dt_util.parse_datetime(value)
+            elif isinstance(value, Number) and not isinstance(value, bool):
+                try:
+                    value = dt_util.utc_from_timestamp(value)
+                except (OSError, OverflowError, ValueError):
+                    return None
+            if not isinstance(value, datetime):
+                return None
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=dt_util.DEFAULT_TIME_ZONE)
+
+            # Whole seconds in local time, the time zone is read on each
+            # call since the configuration can change it at runtime
+            return value.replace(microsecond=0).astimezone(
+                dt_util.DEFAULT_TIME_ZONE).strftime(time_format)
+    elif attr in BATTERY_ATTRIBUTES:
+        def read(state):
+            """Read the battery attribute as float."""
+            value = state.attributes.get(attr)
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return None
+    else:
+        def read(state):
+            """Read the attribute as it is."""
+            value = state.attributes.get(attr)
+            if value is None or isinstance(value, (str, Number)):
+                return value
+            return str(value)
+
+    def access(state):
+        """Read the attribute unless the source is unknown."""
+        if state is None or state.state == STATE_UNKNOWN:
+            return STATE_UNKNOWN
+        return read(state)
+
+    return access
+
+
 class AttributeSensor(RestoreEntity):
     """Representation of a Attribute Sensor."""
 
     def __init__(self, hass, device_id, friendly_name, unit_of_measurement,
-                 state_template, icon_template, entity_id):
-        """Initialize the sensor."""
+                 attribute, accessor, icon, entity_id, min_interval=None):
+        """Initialize the sensor, min_interval is a timedelta or None."""
         self.hass = hass
         self.entity_id = async_generate_entity_id(ENTITY_ID_FORMAT, device_id,
                                                   hass=hass)
+        get_created_entities(hass).add(self.entity_id)
         self._name = friendly_name
         self._unit_of_measurement = unit_of_measurement
-        self._template = state_template
+        self._attribute = attribute
+        self._accessor = accessor
         self._state = None
-        self._icon_template = icon_template
+        self._icon_getter = icon
         self._icon = None
         self._entity = entity_id
+        self._source_state = None
+        self._unsub = None
+        self._min_interval = (
+            min_interval.total_seconds() if min_interval else 0)
+        self._last_write = None
+        self._pending = None
 
     @asyncio.coroutine
     def async_added_to_hass(self):
@@ -176,18 +761,76 @@ class AttributeSensor(RestoreEntity):
         @callback
         def template_sensor_state_listener(entity, old_state, new_state):
             """Handle device state changes."""
-            self.hass.async_add_job(self.async_update_ha_state(True))
+            if self._inputs(new_state) == self._inputs(self._source_state):
+                return
 
-        @callback
-        def template_sensor_startup(event):
-            """Update on startup."""
-            async_track_state_change(
-                self.hass, self._entity, template_sensor_state_listener)
+            self._source_state = new_state
+            self._async_schedule_update()
+
+        self._unsub = get_dispatcher(self.hass).async_track(
+            self._entity, template_sensor_state_listener)
+
+        # A source without state is evaluated by the listener once it
+        # appears, one already there is queued with the other sensors.
+        if self.hass.states.get(self._entity) is not None:
+            get_startup_queue(self.hass).async_add(self._async_first_update)
+
+    @callback
+    def _async_first_update(self):
+        """Evaluate the source unless the listener already did."""
+        if self._unsub is None or self._source_state is not None:
+            return
+
+        self._source_state = self.hass.states.get(self._entity)
+        if self._source_state is not None:
+            self._async_schedule_update()
+
+    def _inputs(self, state):
+        """Return the parts of a source state the sensor depends on."""
+        if state is None:
+            return None
+
+        return (state.state == STATE_UNKNOWN,
+                source_value(state, self._attribute),
+                state.attributes.get(ATTR_FRIENDLY_NAME))
+
+    @callback
+    def _async_schedule_update(self):
+        """Update now, or at the end of the current min_interval window.
+
+        Changes arriving while an update is pending are coalesced into
+        it, the update reads the latest source state when it runs.
+        """
+        if self._pending is not None:
+            return
+
+        now = self.hass.loop.time()
+        if self._last_write is not None:
+            delay = self._last_write + self._min_interval - now
+            if delay > 0:
+                self._pending = async_call_later(
+                    self.hass, delay, self._async_flush)
+                return
 
-            self.hass.async_add_job(self.async_update_ha_state(True))
+        self._last_write = now
+        self.hass.async_add_job(self.async_update_ha_state(True))
 
-        self.hass.bus.async_listen_once(
-            EVENT_HOMEASSISTANT_START, template_sensor_startup)
+    @callback
+    def _async_flush(self, _now):
+        """Write the changes coalesced during the window."""
+        self._pending = None
+        self._last_write = self.hass.loop.time()
+        self.hass.async_add_job(self.async_update_ha_state(True))
+
+    @asyncio.coroutine
+    def async_will_remove_from_hass(self):
+        """Stop watching the source entity."""
+        if self._unsub is not None:
+            self._unsub()
+            self._unsub = None
+        if self._pending is not None:
+            self._pending()
+            self._pending = None
 
     @property
     def name(self):
@@ -216,9 +859,9 @@ class AttributeSensor(RestoreEntity):
 
     @asyncio.coroutine
     def async_update(self):
-        """Update the state from the template and the friendly name."""
+        """Update the state from the source entity and the friendly name."""
 
-        entity_state = self.hass.states.get(self._entity)
+        entity_state = self._source_state
         if entity_state is not None:
             device_friendly_name = entity_state.attributes.get('friendly_name')
         else:
@@ -227,29 +870,80 @@ class AttributeSensor(RestoreEntity):
         if device_friendly_name is not None:
             self._name = device_friendly_name
 
-        try:
-            self._state = self._template.async_render()
-        except TemplateError as ex:
-            if ex.args and ex.args[0].startswith(
-                    "UndefinedError: 'None' has no attribute"):
-                # Common during HA startup - so just a warning
-                _LOGGER.warning('Could not render attribute sensor for %s,'
-                                ' the state is unknown.', self._entity)
-                return
-            self._state = None
-            _LOGGER.error('Could not attribute sensor for %s: %s',
-                          self._entity, ex)
+        self._state = self._accessor(entity_state)
 
-        if self._icon_template is not None:
-            try:
-                self._icon = self._icon_template.async_render()
-            except TemplateError as ex:
-                if ex.args and ex.args[0].startswith(
-                        "UndefinedError: 'None' has no attribute"):
-                    # Common during HA startup - so just a warning
-                    _LOGGER.warning('Could not render icon template %s,'
-                                    ' the state is unknown.', self._name)
-                    return
-                self._icon = super().icon
-                _LOGGER.error('Could not render icon template %s: %s',
-                              self._name, ex)
+        if self._icon_getter is not None:
+            self._icon = self._icon_getter(self._state)
+
+
+class AggregateSensor(Entity):
+    """Representation of an aggregate of an attribute over a group."""
+
+    def __init__(self, hass, device_id, name, unit_of_measurement, kind,
+                 group):
+        """Initialize the sensor."""
+        self.hass = hass
+        self.entity_id = async_generate_entity_id(ENTITY_ID_FORMAT, device_id,
+                                                  hass=hass)
+        get_created_entities(hass).add(self.entity_id)
+        self._name = name
+        self._unit_of_measurement = unit_of_measurement
+        self._kind = kind
+        self._group = group
+        self._state = None
+        self._source = None
+
+    @callback
+    def async_group_changed(self):
+        """Write the state if the aggregate changed."""
+        state, source = self._aggregate()
+        if (state, source) == (self._state, self._source):
+            return
+
+        self._state, self._source = state, source
+        if self.hass.states.get(self.entity_id) is not None:
+            self.hass.async_add_job(self.async_update_ha_state())
+
+    def _aggregate(self):
+        """Return the aggregate and the entity it comes from, if any."""
+        if self._kind == AGGREGATE_MIN:
+            return self._group.minimum()
+        if self._kind == AGGREGATE_MAX:
+            return self._group.maximum()
+        if self._kind == AGGREGATE_MEAN:
+            mean = self._group.mean()
+            return (None if mean is None else round(mean, 2)), None
+        return self._group.count_below(), None
+
+    @asyncio.coroutine
+    def async_added_to_hass(self):
+        """Take the aggregate of the members known at setup."""
+        self._state, self._source = self._aggregate()
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._state
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit_of_measurement of the device."""
+        return self._unit_of_measurement
+
+    @property
+    def device_state_attributes(self):
+        """Return the group size and the entity of a minimum or maximum."""
+        attributes = {'count': len(self._group)}
+        if self._source is not None:
+            attributes['source'] = self._source
+        return attributes
+
+    @property
+    def should_poll(self):
+        """No polling needed."""
+        return False
@@ -1,25 +1,40 @@
 import asyncio
+from collections import deque
 from datetime import timedelta
+import hashlib
 import logging
-from xml.parsers.expat import ExpatError
+import math
+import mmap
+from operator import itemgetter
+import os
+import random
+import struct
+import tarfile
+import time
+from urllib.parse import urljoin, urlparse
+import zipfile
 
 import async_timeout
 import aiohttp
+from aiohttp.hdrs import ETAG, IF_MODIFIED_SINCE, IF_NONE_MATCH, LAST_MODIFIED
 import voluptuous as vol
 
 import homeassistant.helpers.config_validation as cv
 from homeassistant.components.sensor import PLATFORM_SCHEMA
 from homeassistant.const import (
     CONF_MONITORED_CONDITIONS, TEMP_CELSIUS, TEMP_FAHRENHEIT, PRESSURE_HPA,
-    PRESSURE_INHG, LENGTH_METERS, LENGTH_FEET, LENGTH_INCHES, ATTR_ATTRIBUTION)
+    PRESSURE_INHG, LENGTH_METERS, LENGTH_FEET, LENGTH_INCHES, ATTR_ATTRIBUTION,
+    CONF_ICON, CONF_UNIT_OF_MEASUREMENT, EVENT_HOMEASSISTANT_STOP)
 from homeassistant.util import dt as dt_util
 from homeassistant.util.pressure import convert as convert_pressure
 from homeassistant.util.temperature import convert as convert_temperature
 from homeassistant.util.distance import convert as convert_distance
+from homeassistant.core import callback
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
 from homeassistant.helpers.entity import Entity
-from homeassistant.helpers.event import (async_track_utc_time_change,
-                                         async_call_later)
+from homeassistant.helpers.event import async_call_later
+from homeassistant.helpers.storage import STORAGE_DIR
+from homeassistant.util import slugify
 
 __version__ = '1.0.0'
 
@@ -28,76 +43,649 @@ _LOGGER = logging.getLogger(__name__)
 CONF_ATTRIBUTION = "Weather forecast delivered by your WD Clientraw enabled " \
     "weather station."
 
+CLIENTRAW = 'clientraw'
+CLIENTRAW_HOUR = 'clientrawhour'
+CLIENTRAW_EXTRA = 'clientrawextra'
+CLIENTRAW_DAILY = 'clientrawdaily'
+
+# Pseudo file of values aggregated over time windows of clientraw.txt
+WINDOW = 'window'
+
+# File: [file name, minimal number of fields, default interval in minutes]
+# The layout of clientrawextra.txt and clientrawdaily.txt changes between
+# Weather Display versions, their fields are mapped in the configuration
+CLIENTRAW_FILES = {
+    CLIENTRAW: ['clientraw.txt', 115, None],
+    CLIENTRAW_HOUR: ['clientrawhour.txt', 421, 5],
+    CLIENTRAW_EXTRA: ['clientrawextra.txt', 2, 15],
+    CLIENTRAW_DAILY: ['clientrawdaily.txt', 2, 60],
+}
+
+
+def _mean(values):
+    """Return arithmetic mean of the values."""
+    values = list(values)
+    return sum(values) / len(values)
+
+
+# Sensor type: [name, metric unit, imperial unit, icon,
+#               clientraw.txt field index or (file, field index) or
+#               (file, first field, last field + 1, aggregate) or
+#               (WINDOW, window kind, clientraw.txt field index, seconds),
+#               converter, rounding]
 SENSOR_TYPES = {
-    'dewpoint': ['Dewpoint', TEMP_CELSIUS, TEMP_FAHRENHEIT, 'mdi:weather-fog'],
+    'dewpoint': ['Dewpoint', TEMP_CELSIUS, TEMP_FAHRENHEIT, 'mdi:weather-fog',
+                 72, 'temperature', 2],
     'heat_index': ['Heat index', TEMP_CELSIUS, TEMP_FAHRENHEIT,
-                   'mdi:thermometer'],
-    'temp': ['Temperature', TEMP_CELSIUS, TEMP_FAHRENHEIT, 'mdi:thermometer'],
-    'humidex': ['Humidex', TEMP_CELSIUS, TEMP_FAHRENHEIT, 'mdi:thermometer'],
-    'wind_degrees': ['Wind Degrees', '°', '°', 'mdi:subdirectory-arrow-right'],
-    'wind_dir': ['Wind Direction', None, None, 'mdi:subdirectory-arrow-right'],
-    'wind_gust': ['Wind Gust', 'km/h', 'mph', 'mdi:weather-windy'],
-    'wind_speed': ['Wind Speed', 'km/h', 'mph', 'mdi:weather-windy-variant'],
-    'symbol': ['Symbol', None, None, 'mdi:triangle-outline'],
-    'daily_rain': ['Daily Rain', 'mm', LENGTH_INCHES, 'mdi:weather-rainy'],
-    'rain_rate': ['Rain Rate', 'mm', LENGTH_INCHES, 'mdi:weather-rainy'],
-    'pressure': ['Pressure', PRESSURE_HPA, PRESSURE_INHG, 'mdi:trending-up'],
-    'humidity': ['Humidity', '%', '%', 'mdi:water-percent'],
+                   'mdi:thermometer', 112, 'temperature', 2],
+    'temp': ['Temperature', TEMP_CELSIUS, TEMP_FAHRENHEIT, 'mdi:thermometer',
+             4, 'temperature', 2],
+    'humidex': ['Humidex', TEMP_CELSIUS, TEMP_FAHRENHEIT, 'mdi:thermometer',
+                44, 'temperature', 2],
+    'wind_degrees': ['Wind Degrees', '°', '°', 'mdi:subdirectory-arrow-right',
+                     3, 'float', None],
+    'wind_dir': ['Wind Direction', None, None, 'mdi:subdirectory-arrow-right',
+                 3, 'wind_dir', None],
+    'wind_gust': ['Wind Gust', 'km/h', 'mph', 'mdi:weather-windy',
+                  2, 'speed', 2],
+    'wind_speed': ['Wind Speed', 'km/h', 'mph', 'mdi:weather-windy-variant',
+                   1, 'speed', 2],
+    'symbol': ['Symbol', None, None, 'mdi:triangle-outline',
+               48, 'int', None],
+    'daily_rain': ['Daily Rain', 'mm', LENGTH_INCHES, 'mdi:weather-rainy',
+                   7, 'rain', 2],
+    'rain_rate': ['Rain Rate', 'mm', LENGTH_INCHES, 'mdi:weather-rainy',
+                  10, 'rain', 2],
+    'pressure': ['Pressure', PRESSURE_HPA, PRESSURE_INHG, 'mdi:trending-up',
+                 6, 'pressure', 2],
+    'humidity': ['Humidity', '%', '%', 'mdi:water-percent',
+                 5, 'float', None],
     'cloud_height': ['Cloud Height', LENGTH_METERS, LENGTH_FEET,
-                     'mdi:cloud-outline'],
-    'forecast': ['Forecast', None, None, "mdi:card-text-outline"]
+                     'mdi:cloud-outline', 73, 'distance', 2],
+    'forecast': ['Forecast', None, None, "mdi:card-text-outline",
+                 15, 'forecast', None],
+    'wind_speed_hour_avg': ['Wind Speed Last Hour', 'km/h', 'mph',
+                            'mdi:weather-windy-variant',
+                            (CLIENTRAW_HOUR, 1, 61, _mean), 'speed', 2],
+    'wind_gust_hour_max': ['Wind Gust Last Hour', 'km/h', 'mph',
+                           'mdi:weather-windy',
+                           (CLIENTRAW_HOUR, 61, 121, max), 'speed', 2],
+    'temp_hour_max': ['Temperature Max Last Hour', TEMP_CELSIUS,
+                      TEMP_FAHRENHEIT, 'mdi:thermometer',
+                      (CLIENTRAW_HOUR, 181, 241, max), 'temperature', 2],
+    'temp_hour_min': ['Temperature Min Last Hour', TEMP_CELSIUS,
+                      TEMP_FAHRENHEIT, 'mdi:thermometer',
+                      (CLIENTRAW_HOUR, 181, 241, min), 'temperature', 2],
+    'wind_speed_10min_avg': ['Wind Speed 10 Min Average', 'km/h', 'mph',
+                             'mdi:weather-windy-variant',
+                             (WINDOW, 'mean', 1, 600), 'speed', 2],
+    'wind_gust_10min_max': ['Wind Gust 10 Min Peak', 'km/h', 'mph',
+                            'mdi:weather-windy',
+                            (WINDOW, 'max', 2, 600), 'speed', 2],
+    'wind_degrees_10min_avg': ['Wind Degrees 10 Min Average', '°', '°',
+                               'mdi:subdirectory-arrow-right',
+                               (WINDOW, 'direction', 3, 600), 'float', 0],
+    'rain_1h': ['Rain Last Hour', 'mm', LENGTH_INCHES, 'mdi:weather-rainy',
+                (WINDOW, 'rain', 7, 3600), 'rain', 2],
+    'rain_24h': ['Rain Last 24 Hours', 'mm', LENGTH_INCHES,
+                 'mdi:weather-rainy', (WINDOW, 'rain', 7, 86400), 'rain', 2],
+}
+
+WIND_DIRECTIONS = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
+                   "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
+
+FORECASTS = ["sunny", "clearnight", "cloudy", "cloudy2", "night cloudy",
+             "dry", "fog", "haze", "heavyrain", "mainlyfine", "mist",
+             "night fog", "night heavyrain", "night overcast", "night rain",
+             "night showers", "night snow", "night", "thunder", "overcast",
+             "partlycloudy", "rain", "rain2", "showers2", "sleet",
+             "sleetshowers", "snow", "snowmelt", "snowshowers2", "sunny",
+             "thundershowers", "thundershowers2", "thunderstorms", "tornado",
+             "windy", "stopped", "rainning", "wind + rain"]
+
+
+# Fields kept in the history, every clientraw.txt field used by a sensor
+HISTORY_FIELDS = sorted({sensor[4] for sensor in SENSOR_TYPES.values()
+                         if isinstance(sensor[4], int)})
+
+
+def _wind_dir(value):
+    """Translate wind degrees into a compass point."""
+    return WIND_DIRECTIONS[int((float(value) / 22.5) + .5) % 16]
+
+
+def _number_or_text(value):
+    """Return a field as number if it is one."""
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def _forecast(value):
+    """Translate forecast icon number into its name."""
+    val = int(value)
+    return FORECASTS[val] if val < len(FORECASTS) else "unknown"
+
+
+# Converter: (metric, imperial), wind speeds are reported in knots
+CONVERTERS = {
+    'float': (float, float),
+    'int': (int, int),
+    'temperature': (
+        float,
+        lambda value: convert_temperature(
+            float(value), TEMP_CELSIUS, TEMP_FAHRENHEIT)),
+    'speed': (
+        lambda value: float(value) * 1.85166,
+        lambda value: float(value) * 1.1507794),
+    'rain': (
+        float,
+        lambda value: float(value) * 0.0393700787),
+    'pressure': (
+        float,
+        lambda value: convert_pressure(
+            float(value), PRESSURE_HPA, PRESSURE_INHG)),
+    'distance': (
+        float,
+        lambda value: convert_distance(
+            float(value), LENGTH_METERS, LENGTH_FEET)),
+    'wind_dir': (_wind_dir, _wind_dir),
+    'forecast': (_forecast, _forecast),
+    'field': (_number_or_text, _number_or_text),
+}
+
+
+def _field_getter(position):
+    """Return file and getter of a sensor type field position."""
+    if isinstance(position, int):
+        return CLIENTRAW, itemgetter(position)
+    if position[0] == WINDOW:
+        return WINDOW, itemgetter(position)
+    if len(position) == 2:
+        return position[0], itemgetter(position[1])
+
+    file, first, stop, aggregate = position
+
+    def get(fields):
+        """Aggregate a block of fields."""
+        if len(fields) < stop:
+            raise IndexError('block {}-{} out of range'.format(first, stop))
+        return aggregate(float(value) for value in fields[first:stop])
+
+    return file, get
+
+
+def _missing(value):
+    """Return True for NaN or infinite numbers, ie. unparsed history."""
+    return isinstance(value, float) and not math.isfinite(value)
+
+
+class ClientrawDecoder(object):
+    """Decode split clientraw fields into sensor states."""
+
+    def __init__(self, sensor_types, is_metric, specs=None):
+        """Compile the decode table for the monitored sensor types.
+
+        Specs maps types missing from SENSOR_TYPES to their row.
+        """
+        specs = specs or {}
+        unit_system = 0 if is_metric else 1
+        self._table = []
+        self.files = set()
+        self.windows = set()
+        self.failed = set()
+
+        for sensor_type in dict.fromkeys(sensor_types):
+            spec = specs.get(sensor_type) or SENSOR_TYPES[sensor_type]
+            position, converter, ndigits = spec[4:7]
+            file, getter = _field_getter(position)
+            if file == WINDOW:
+                self.windows.add(position)
+            else:
+                self.files.add(file)
+            self._table.append((sensor_type, file, getter,
+                                CONVERTERS[converter][unit_system], ndigits))
+
+    def decode(self, files):
+        """Return a dict of sensor type to decoded state.
+
+        Files maps file to its split fields, types of missing files and
+        types whose field can't be decoded or is NaN, as history keeps
+        unparsed fields, are left out, so one bad field only affects the
+        conditions reading it.
+        """
+        states = {}
+
+        for sensor_type, file, getter, converter, ndigits in self._table:
+            fields = files.get(file)
+            if fields is None:
+                continue
+
+            try:
+                value = getter(fields)
+                if value is None or _missing(value):
+                    continue
+
+                value = converter(value)
+                if _missing(value):
+                    continue
+
+                if ndigits is not None:
+                    value = round(value, ndigits)
+            except (IndexError, OverflowError, ValueError) as err:
+                if sensor_type not in self.failed:
+                    self.failed.add(sensor_type)
+                    _LOGGER.warning("Can't decode %s: %s", sensor_type, err)
+                continue
+
+            states[sensor_type] = value
+
+        return states
+
+
+class RollingWindow(object):
+    """Samples of the last given seconds, updated in amortized O(1)."""
+
+    def __init__(self, seconds):
+        """Initialize the window."""
+        self.seconds = seconds
+        self._samples = deque()
+
+    def add(self, timestamp, value):
+        """Add a sample and drop the ones that left the window."""
+        self._samples.append((timestamp, value))
+        self._added(value)
+
+        while self._samples[0][0] <= timestamp - self.seconds:
+            self._removed(self._samples.popleft()[1])
+
+    def _added(self, value):
+        """Account a new sample."""
+
+    def _removed(self, value):
+        """Account a sample that left the window."""
+
+
+class MeanWindow(RollingWindow):
+    """Arithmetic mean over a window."""
+
+    def __init__(self, seconds):
+        """Initialize the window."""
+        super().__init__(seconds)
+        self._sum = 0
+
+    def _added(self, value):
+        """Account a new sample."""
+        self._sum += value
+
+    def _removed(self, value):
+        """Account a sample that left the window."""
+        self._sum -= value
+
+    @property
+    def value(self):
+        """Return the mean."""
+        return self._sum / len(self._samples) if self._samples else None
+
+
+class MaxWindow(RollingWindow):
+    """Maximum over a window using a monotonic deque."""
+
+    def __init__(self, seconds):
+        """Initialize the window."""
+        super().__init__(seconds)
+        self._peaks = deque()
+
+    def add(self, timestamp, value):
+        """Add a sample and drop the ones that left the window."""
+        while self._peaks and self._peaks[-1][1] <= value:
+            self._peaks.pop()
+        self._peaks.append((timestamp, value))
+
+        while self._peaks[0][0] <= timestamp - self.seconds:
+            self._peaks.popleft()
+
+    @property
+    def value(self):
+        """Return the maximum."""
+        return self._peaks[0][1] if self._peaks else None
+
+
+class DirectionWindow(RollingWindow):
+    """Vector average of compass directions over a window."""
+
+    def __init__(self, seconds):
+        """Initialize the window."""
+        super().__init__(seconds)
+        self._sin = 0
+        self._cos = 0
+
+    def add(self, timestamp, value):
+        """Add a direction in degrees."""
+        radians = math.radians(value)
+        super().add(timestamp, (math.sin(radians), math.cos(radians)))
+
+    def _added(self, value):
+        """Account a new sample."""
+        self._sin += value[0]
+        self._cos += value[1]
+
+    def _removed(self, value):
+        """Account a sample that left the window."""
+        self._sin -= value[0]
+        self._cos -= value[1]
+
+    @property
+    def value(self):
+        """Return the average direction in degrees."""
+        if not self._samples:
+            return None
+        return round(math.degrees(math.atan2(self._sin, self._cos)), 6) % 360
+
+
+class RainWindow(MeanWindow):
+    """Rain fallen within a window from the daily rain total."""
+
+    def __init__(self, seconds):
+        """Initialize the window."""
+        super().__init__(seconds)
+        self._total = None
+
+    def add(self, timestamp, value):
+        """Add a daily rain total, which drops back at midnight."""
+        if self._total is None:
+            rain = 0
+        elif value >= self._total:
+            rain = value - self._total
+        else:
+            rain = value
+        self._total = value
+        super().add(timestamp, rain)
+
+    @property
+    def value(self):
+        """Return the rain sum."""
+        return self._sum if self._samples else None
+
+
+WINDOW_KINDS = {
+    'mean': MeanWindow,
+    'max': MaxWindow,
+    'direction': DirectionWindow,
+    'rain': RainWindow,
 }
 
+
 CONF_URL = 'url'
 CONF_INTERVAL = 'interval'
 CONF_NAME = 'name'
+CONF_HISTORY = 'history'
+CONF_FILE_INTERVALS = 'file_intervals'
+CONF_DEADBAND = 'deadband'
+CONF_ABSOLUTE = 'absolute'
+CONF_RELATIVE = 'relative'
+CONF_MAX_AGE = 'max_age'
+CONF_DIAGNOSTICS = 'diagnostics'
+CONF_REPLAY_SPEED = 'replay_speed'
+CONF_FIELDS = 'fields'
+CONF_FILE = 'file'
+CONF_INDEX = 'index'
+DEFAULT_REPLAY_SPEED = 60
 DEFAULT_NAME = 'clientraw'
+DEFAULT_HISTORY = 1440
 
-PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
-    vol.Required(CONF_MONITORED_CONDITIONS, default=[]):
-        vol.All(cv.ensure_list, [vol.In(SENSOR_TYPES.keys())]),
-    vol.Required(CONF_URL, default=[]): cv.url,
+DOMAIN = 'clientraw'
+DATA_CLIENTRAW = 'clientraw'
+
+# Retry delay after a failed poll in seconds, doubled on every
+# consecutive failure up to the maximum
+RETRY_DELAY = 2 * 60
+RETRY_MAX_DELAY = 30 * 60
+
+# How often a local clientraw file is checked for changes in seconds
+FILE_POLL_INTERVAL = 1
+
+# Seconds a fetch or a pushed payload may take
+FETCH_TIMEOUT = 10
+
+# Largest payload accepted from a pushing station
+MAX_PUSH_SIZE = 64 * 1024
+
+# Number of fetch latencies kept for the histogram and its buckets in ms
+LATENCY_SAMPLES = 1000
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+SERVICE_DUMP_LATENCY = 'dump_latency'
+
+SERVICE_DUMP_LATENCY_SCHEMA = vol.Schema({
+    vol.Optional(CONF_URL): cv.string,
+})
+
+# Minimum seconds between two writes of a measured diagnostic, a local
+# file is polled every second
+DIAGNOSTIC_WRITE_INTERVAL = 60
+
+# Diagnostic type: [name, unit, icon]
+DIAGNOSTIC_TYPES = {
+    'fetch_latency': ['Fetch Latency', 'ms', 'mdi:timer'],
+    'payload_bytes': ['Payload Size', 'B', 'mdi:file-outline'],
+    'parse_time': ['Parse Time', 'ms', 'mdi:timer'],
+    'consecutive_failures': ['Consecutive Failures', None,
+                             'mdi:alert-circle-outline'],
+    'retries': ['Retries', None, 'mdi:refresh'],
+    'last_success': ['Last Successful Update', None, 'mdi:clock-outline'],
+}
+
+SOURCE_HTTP = ('http', 'https')
+SOURCE_FILE = 'file'
+SOURCE_PUSH = ('udp', 'tcp')
+SOURCE_REPLAY = 'replay'
+
+
+def clientraw_source(value):
+    """Validate a clientraw url, local path or push listener address."""
+    value = cv.string(value)
+    parsed = urlparse(value)
+
+    if parsed.scheme in SOURCE_HTTP:
+        return cv.url(value)
+    if parsed.scheme in SOURCE_PUSH:
+        if parsed.port is None:
+            raise vol.Invalid('push listener needs a port')
+        return value
+    if parsed.scheme == SOURCE_REPLAY:
+        if not os.path.isabs(parsed.path):
+            raise vol.Invalid('replay needs an absolute path')
+        return value
+    if parsed.scheme == SOURCE_FILE or os.path.isabs(value):
+        return value
+
+    raise vol.Invalid('invalid clientraw source: {}'.format(value))
+
+
+DEADBAND_SCHEMA = vol.Schema({
+    vol.Optional(CONF_ABSOLUTE, default=0):
+        vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_RELATIVE, default=0):
+        vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_MAX_AGE):
+        vol.All(vol.Coerce(int), vol.Range(min=1)),
+})
+
+# Options of the shared data object, used by the weather platform too
+STATION_SCHEMA = {
+    vol.Required(CONF_URL, default=[]): clientraw_source,
     vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
     vol.Optional(CONF_INTERVAL, default=15):
         vol.All(vol.Coerce(int), vol.Range(min=1, max=59)),
+    vol.Optional(CONF_HISTORY, default=DEFAULT_HISTORY):
+        vol.All(vol.Coerce(int), vol.Range(min=0)),
+    vol.Optional(CONF_FILE_INTERVALS, default={}): {
+        vol.In([file for file in CLIENTRAW_FILES if file != CLIENTRAW]):
+            vol.All(vol.Coerce(int), vol.Range(min=1)),
+    },
+    vol.Optional(CONF_REPLAY_SPEED, default=DEFAULT_REPLAY_SPEED):
+        vol.All(vol.Coerce(float), vol.Range(min=0, min_included=False)),
+}
+
+FIELD_SCHEMA = vol.Schema({
+    vol.Required(CONF_NAME): cv.string,
+    vol.Required(CONF_FILE): vol.In(CLIENTRAW_FILES),
+    vol.Required(CONF_INDEX): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    vol.Optional(CONF_UNIT_OF_MEASUREMENT): cv.string,
+    vol.Optional(CONF_ICON, default='mdi:eye'): cv.icon,
+})
+
+# Options only the first entry of a shared url applies
+STATION_OPTIONS = (CONF_HISTORY, CONF_FILE_INTERVALS, CONF_REPLAY_SPEED)
+
+PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(STATION_SCHEMA).extend({
+    vol.Required(CONF_MONITORED_CONDITIONS, default=[]):
+        vol.All(cv.ensure_list, [vol.In(SENSOR_TYPES.keys())]),
+    vol.Optional(CONF_DEADBAND, default={}): {
+        vol.In(SENSOR_TYPES.keys()): DEADBAND_SCHEMA,
+    },
+    vol.Optional(CONF_DIAGNOSTICS, default=False): cv.boolean,
+    vol.Optional(CONF_FIELDS, default=[]):
+        vol.All(cv.ensure_list, [FIELD_SCHEMA]),
 })
 
 
 async def async_setup_platform(hass, config, async_add_entities,
                                discovery_info=None):
     """Set up the Clientraw sensor."""
-    url = config.get(CONF_URL)
-    interval = config.get(CONF_INTERVAL)
     name = config.get(CONF_NAME)
 
-    _LOGGER.debug("Clientraw setup interval %s", interval)
+    _LOGGER.debug("Clientraw setup interval %s", config.get(CONF_INTERVAL))
 
     dev = []
     for sensor_type in config[CONF_MONITORED_CONDITIONS]:
         dev.append(ClientrawSensor(
-            hass.config.units.is_metric, sensor_type, name))
-    async_add_entities(dev)
+            hass.config.units.is_metric, sensor_type, name,
+            config[CONF_DEADBAND].get(sensor_type)))
+
+    for field in config[CONF_FIELDS]:
+        sensor_type, spec = field_sensor_type(field)
+        dev.append(ClientrawSensor(
+            hass.config.units.is_metric, sensor_type, name, spec=spec))
+
+    if config[CONF_DIAGNOSTICS]:
+        diagnostics = [ClientrawDiagnosticSensor(diagnostic_type, name)
+                       for diagnostic_type in DIAGNOSTIC_TYPES]
+    else:
+        diagnostics = []
 
-    weather = ClientrawData(hass, url, interval, dev)
-    # Update weather per interval
-    async_track_utc_time_change(hass, weather.async_update,
-                                minute=interval, second=0)
-    await weather.async_update()
+    async_add_entities(dev + diagnostics)
+    await async_setup_station(hass, config, dev, diagnostics=diagnostics)
+
+
+def field_sensor_type(field):
+    """Return the sensor type and its SENSOR_TYPES like row of a field."""
+    unit = field.get(CONF_UNIT_OF_MEASUREMENT)
+    return '{}_{}'.format(field[CONF_FILE], field[CONF_INDEX]), [
+        field[CONF_NAME], unit, unit, field[CONF_ICON],
+        (field[CONF_FILE], field[CONF_INDEX]), 'field', None]
+
+
+async def async_setup_station(hass, config, devices, aggregates=(),
+                              diagnostics=()):
+    """Register entities with the data object of a url.
+
+    The data object is created and started by the first platform entry
+    of the url, the others share it.
+    """
+    url = config.get(CONF_URL)
+    interval = config.get(CONF_INTERVAL)
+    stations = hass.data.setdefault(DATA_CLIENTRAW, {})
+
+    if not hass.services.has_service(DOMAIN, SERVICE_DUMP_LATENCY):
+        @callback
+        def dump_latency(call):
+            """Log fetch latency histograms."""
+            for station in stations.values():
+                if call.data.get(CONF_URL) in (None, station.url):
+                    station.log_latency_histogram()
+
+        hass.services.async_register(
+            DOMAIN, SERVICE_DUMP_LATENCY, dump_latency,
+            schema=SERVICE_DUMP_LATENCY_SCHEMA)
+
+    if url in stations:
+        _LOGGER.debug("Sharing existing fetch of %s", url)
+        weather = stations[url]
+        for option in STATION_OPTIONS:
+            if config[option] != weather.options[option]:
+                _LOGGER.warning(
+                    "%s of %s is taken from its first entry, ignoring %s",
+                    option, url, config[option])
+        weather.add_diagnostics(diagnostics)
+        await weather.async_add_devices(devices, interval, aggregates)
+        return weather
+
+    history = None
+    if config[CONF_HISTORY]:
+        history = ClientrawHistory(
+            hass.config.path(STORAGE_DIR, 'clientraw_{}.ring'.format(
+                slugify(url))),
+            config[CONF_HISTORY])
+
+    weather = ClientrawData(hass, url, interval, devices, history,
+                            config[CONF_FILE_INTERVALS],
+                            config[CONF_REPLAY_SPEED], aggregates)
+    weather.options = {option: config[option] for option in STATION_OPTIONS}
+    weather.add_diagnostics(diagnostics)
+    stations[url] = weather
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, weather.async_stop)
+    await weather.async_start()
+    return weather
 
 
 class ClientrawSensor(Entity):
     """Representation of an clientraw sensor."""
 
-    def __init__(self, is_metric, sensor_type, name):
-        """Initialize the sensor."""
+    def __init__(self, is_metric, sensor_type, name, deadband=None,
+                 spec=None):
+        """Initialize the sensor, spec defaults to its SENSOR_TYPES row."""
         self.client_name = name
         self.type = sensor_type
-        self._name = SENSOR_TYPES[sensor_type][0]
+        self.spec = spec or SENSOR_TYPES[sensor_type]
+        self._name = self.spec[0]
         self._state = None
-        self._metric_unit_of_measurement = SENSOR_TYPES[self.type][1]
-        self._imperial_unit_of_measurement = SENSOR_TYPES[self.type][2]
-        self._icon = SENSOR_TYPES[self.type][3]
+        self._metric_unit_of_measurement = self.spec[1]
+        self._imperial_unit_of_measurement = self.spec[2]
+        self._icon = self.spec[3]
         self._is_metric = is_metric
+        deadband = deadband or {}
+        self._absolute = deadband.get(CONF_ABSOLUTE, 0)
+        self._relative = deadband.get(CONF_RELATIVE, 0)
+        self._max_age = deadband.get(CONF_MAX_AGE)
+        if self._max_age is not None:
+            self._max_age *= 60
+        self._written_at = None
+
+    def should_update(self, new_state, now):
+        """Return True if the new state is worth writing.
+
+        Numeric changes within the deadband are dropped until max_age
+        seconds have passed since the last written state.
+        """
+        if new_state == self._state:
+            return False
+
+        if (self._state is None or self._written_at is None or
+                not isinstance(new_state, float) or
+                not isinstance(self._state, float)):
+            return True
+
+        change = abs(new_state - self._state)
+        if (change > self._absolute and
+                change > self._relative * abs(self._state)):
+            return True
+
+        return (self._max_age is not None and
+                now - self._written_at >= self._max_age)
 
     @property
     def name(self):
@@ -136,183 +724,926 @@ class ClientrawSensor(Entity):
         return self._icon
 
 
-class ClientrawData(object):
-    """Get the latest data and updates the states."""
+class ClientrawDiagnosticSensor(Entity):
+    """Representation of a clientraw fetch diagnostic sensor."""
 
-    def __init__(self, hass, url, interval, devices):
-        """Initialize the data object."""
-        self._url = url
-        self.devices = devices
-        self.data = {}
-        self.hass = hass
-        self._interval = interval
+    def __init__(self, diagnostic_type, name):
+        """Initialize the sensor."""
+        self.client_name = name
+        self.type = diagnostic_type
+        self.weather = None
+        self._name = DIAGNOSTIC_TYPES[diagnostic_type][0]
+        self._unit_of_measurement = DIAGNOSTIC_TYPES[diagnostic_type][1]
+        self._icon = DIAGNOSTIC_TYPES[diagnostic_type][2]
+        self._state = None
+        self._written_at = None
+        self._failing = False
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return '{} {}'.format(self.client_name, self._name)
 
-    async def async_update(self, *_):
-        """Get the latest data"""
+    @property
+    def state(self):
+        """Return the state of the device."""
+        return self._state
 
-        def try_again(err: str):
-            """Retry"""
-            _LOGGER.error("Will try again shortly: %s", err)
-            async_call_later(self.hass, 2 * 60, self.async_update)
-        try:
-            websession = async_get_clientsession(self.hass)
-            with async_timeout.timeout(10, loop=self.hass.loop):
-                resp = await websession.get(self._url)
-            if resp.status != 200:
-                try_again('{} returned {}'.format(resp.url, resp.status))
-                return
-            text = await resp.text()
+    @property
+    def should_poll(self):
+        """No polling needed."""
+        return False
 
-        except (asyncio.TimeoutError, aiohttp.ClientError) as err:
-            try_again(err)
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement of this entity, if any."""
+        return self._unit_of_measurement
+
+    @property
+    def icon(self):
+        """Return the icon of this entity, if any."""
+        return self._icon
+
+    @callback
+    def async_update_from_weather(self):
+        """Take the current value from the data object."""
+        poller = self.weather.poller
+        failing = poller.failures > 0
+        if self.type == 'consecutive_failures':
+            state = poller.failures
+        elif self.type == 'retries':
+            state = poller.retries
+        elif self.type == 'last_success':
+            state = self.weather.last_success
+            if state is not None:
+                state = state.isoformat()
+        else:
+            state = getattr(self.weather, self.type)
+            if state is not None:
+                state = round(state, 1)
+
+        if state == self._state:
             return
 
-        try:
-            self.data = text.split(' ')
+        # Measurements and failure counters can change on every poll, a
+        # local file is polled every second, so they are written at most
+        # once per DIAGNOSTIC_WRITE_INTERVAL, or when a failure streak
+        # starts or ends
+        now = time.monotonic()
+        if (self.type != 'last_success' and failing == self._failing and
+                self._written_at is not None and
+                now - self._written_at < DIAGNOSTIC_WRITE_INTERVAL):
+            return
+
+        self._state = state
+        self._failing = failing
+        self._written_at = now
+        if self.hass is not None:
+            self.async_write_ha_state()
+
+
+class ClientrawHistory(object):
+    """Fixed size ring of raw samples in a memory mapped file.
+
+    Every slot holds the sample timestamp followed by the fields listed
+    in HISTORY_FIELDS as doubles, so samples decode with the same
+    ClientrawDecoder as a downloaded file.
+    """
+
+    HEADER = struct.Struct('<4sHHIQ')
+    MAGIC = b'CRAW'
+    VERSION = 1
+
+    def __init__(self, path, slots):
+        """Initialize the history."""
+        self.path = path
+        self.slots = slots
+        self.count = 0
+        self._record = struct.Struct('<d{}d'.format(len(HISTORY_FIELDS)))
+        self._mmap = None
+
+    def open(self):
+        """Map the ring file, recreating it if its layout changed."""
+        size = self.HEADER.size + self.slots * self._record.size
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644),
+                       'r+b') as ring:
+            header = ring.read(self.HEADER.size)
+            valid = (len(header) == self.HEADER.size and
+                     self.HEADER.unpack(header)[:4] == (
+                         self.MAGIC, self.VERSION, len(HISTORY_FIELDS),
+                         self.slots) and
+                     os.fstat(ring.fileno()).st_size == size)
+
+            if not valid:
+                _LOGGER.debug("Creating history %s", self.path)
+                ring.truncate(0)
+                ring.truncate(size)
+
+            self._mmap = mmap.mmap(ring.fileno(), size)
+
+        if valid:
+            self.count = self.HEADER.unpack_from(self._mmap)[4]
+        else:
+            self._write_header()
+
+    def close(self):
+        """Flush and unmap the ring file."""
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+
+    def _write_header(self):
+        """Store the header."""
+        self.HEADER.pack_into(self._mmap, 0, self.MAGIC, self.VERSION,
+                              len(HISTORY_FIELDS), self.slots, self.count)
+
+    def append(self, timestamp, fields):
+        """Store a sample in the next slot."""
+        if self._mmap is None:
+            return
+
+        values = []
+        for index in HISTORY_FIELDS:
+            try:
+                values.append(float(fields[index]))
+            except (IndexError, ValueError):
+                values.append(float('nan'))
+
+        slot = self.count % self.slots
+        self._record.pack_into(
+            self._mmap, self.HEADER.size + slot * self._record.size,
+            timestamp, *values)
+        self.count += 1
+        self._write_header()
+
+    def _read(self, slot):
+        """Return timestamp and fields of a slot."""
+        sample = self._record.unpack_from(
+            self._mmap, self.HEADER.size + slot * self._record.size)
+        fields = [float('nan')] * (HISTORY_FIELDS[-1] + 1)
+
+        for index, value in zip(HISTORY_FIELDS, sample[1:]):
+            fields[index] = value
+
+        return sample[0], fields
+
+    def last(self):
+        """Return timestamp and fields of the newest sample or None."""
+        if not self.count:
+            return None
+
+        return self._read((self.count - 1) % self.slots)
+
+    def samples(self, since=0):
+        """Return timestamp and fields of stored samples, oldest first."""
+        first = max(0, self.count - self.slots)
+        samples = []
 
-            if len(self.data) < 115:
-                raise ValueError('Could not parse the file')
-        except (ExpatError, IndexError) as err:
-            try_again(err)
+        for number in range(first, self.count):
+            timestamp, fields = self._read(number % self.slots)
+            if timestamp >= since:
+                samples.append((timestamp, fields))
+
+        return samples
+
+
+class ClientrawPoller(object):
+    """Own the poll timer of a data object.
+
+    Only one timer is ever pending and a poll that fires while the
+    previous one is still running is dropped, so there can't be more
+    than one poll per min(interval, RETRY_DELAY / 2).
+
+    With a retry interval failed polls are retried at that fixed pace
+    instead of backing off.
+    """
+
+    def __init__(self, hass, interval, action, listener=None,
+                 retry_interval=None):
+        """Initialize the poller, intervals are in seconds."""
+        self.hass = hass
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.failures = 0
+        self.retries = 0
+        self._action = action
+        self._listener = listener
+        self._unsub = None
+        self._running = False
+        self._stopped = False
+
+    async def async_start(self):
+        """Poll right away and keep polling."""
+        await self.async_poll()
+
+    @callback
+    def stop(self, *_):
+        """Cancel the pending poll and don't schedule any more."""
+        self._stopped = True
+        self._cancel()
+
+    @callback
+    def async_set_interval(self, interval):
+        """Shorten the interval, a pending poll is re-armed to it."""
+        if interval >= self.interval:
             return
 
-        if not self.data:
+        self.interval = interval
+        if self._unsub is None or self.failures:
             return
 
-        # Update all devices
-        tasks = []
+        self._cancel()
+        self._unsub = async_call_later(self.hass, interval, self.async_poll)
 
-        for dev in self.devices:
-            new_state = None
+    @callback
+    def _cancel(self):
+        """Cancel the pending poll."""
+        if self._unsub is not None:
+            self._unsub()
+            self._unsub = None
 
-            if dev.type == 'symbol':
-                new_state = int(self.data[48])
+    async def async_poll(self, *_):
+        """Run the action and schedule the next poll."""
+        if self._stopped:
+            return
+        if self._running:
+            _LOGGER.debug("Previous poll still running, skipping")
+            return
 
-            elif dev.type == 'daily_rain':
-                rain = float(self.data[7])
+        self._unsub = None
+        self._running = True
+        try:
+            success = await self._action()
+        finally:
+            self._running = False
 
-                if not self.hass.config.units.is_metric:
-                    rain = rain * 0.0393700787
+        if success:
+            self.failures = 0
+            delay = self.interval
+        else:
+            self.failures += 1
+            self.retries += 1
+            if self.retry_interval is not None:
+                delay = self.retry_interval
+                _LOGGER.debug("Will try again in %d seconds", delay)
+            else:
+                delay = self.retry_delay(self.failures)
+                _LOGGER.error("Will try again in %d seconds", delay)
+
+        self._cancel()
+        if self._stopped:
+            return
+        self._unsub = async_call_later(self.hass, delay, self.async_poll)
+
+        if self._listener is not None:
+            self._listener()
+
+    @staticmethod
+    def retry_delay(failures):
+        """Return jittered exponential backoff after given failures."""
+        delay = min(RETRY_DELAY * 2 ** (failures - 1), RETRY_MAX_DELAY)
+        return random.uniform(delay / 2, delay)
+
+
+def _read_file(path):
+    """Read a local file."""
+    with open(path, 'rb') as clientraw:
+        return clientraw.read()
+
+
+class ClientrawArchive(object):
+    """Recorded clientraw.txt snapshots in a directory, zip or tar file.
+
+    Snapshots are ordered by their modification time, then by name.
+    """
+
+    def __init__(self, path):
+        """Initialize the archive."""
+        self.path = path
+        self.snapshots = []
+        self._archive = None
+
+    def open(self):
+        """Open the archive and list its snapshots."""
+        if os.path.isdir(self.path):
+            for entry in os.scandir(self.path):
+                if entry.is_file():
+                    self.snapshots.append(
+                        (entry.stat().st_mtime, entry.path))
+        elif zipfile.is_zipfile(self.path):
+            self._archive = zipfile.ZipFile(self.path)
+            for info in self._archive.infolist():
+                if not info.is_dir():
+                    self.snapshots.append(
+                        (time.mktime(info.date_time + (0, 0, -1)),
+                         info.filename))
+        else:
+            self._archive = tarfile.open(self.path)
+            for info in self._archive.getmembers():
+                if info.isfile():
+                    self.snapshots.append((info.mtime, info.name))
+
+        self.snapshots.sort()
+
+    def read(self, member):
+        """Return the payload of a snapshot."""
+        if self._archive is None:
+            return _read_file(member)
+        if isinstance(self._archive, zipfile.ZipFile):
+            return self._archive.read(member)
+
+        return self._archive.extractfile(member).read()
+
+    def close(self):
+        """Close the archive."""
+        if self._archive is not None:
+            self._archive.close()
+            self._archive = None
+
+
+class ClientrawFile(object):
+    """State of one of the files Weather Display publishes."""
+
+    def __init__(self, location, min_fields, interval):
+        """Initialize the file, interval is in seconds or None."""
+        self.location = location
+        self.min_fields = min_fields
+        self.interval = interval
+        self.fields = None
+        self.digest = None
+        self.etag = None
+        self.last_modified = None
+        self.validators = None
+        self.signature = None
+        self.pending_signature = None
+        # True from a failed read or parse until a payload is applied
+        self.failing = False
+        self._next_fetch = 0
+
+    def due(self, now):
+        """Return True if the file is due."""
+        return self.interval is None or now >= self._next_fetch
+
+    def fetched(self, now):
+        """Plan the next fetch after a successful one."""
+        if self.interval is not None:
+            self._next_fetch = now + self.interval
+
+    def parse(self, body):
+        """Return digest and fields of a payload, None if unchanged."""
+        digest = hashlib.sha1(body).digest()
+        if digest == self.digest:
+            return None
+
+        fields = body.decode('utf-8', 'replace').split(' ')
+        if len(fields) < self.min_fields:
+            raise ValueError('Could not parse the file')
+
+        return digest, fields
+
+    def commit(self, digest=None, fields=None):
+        """Keep an applied payload and the validators it was fetched with.
+
+        Without digest the payload was unchanged and only the validators
+        are kept.
+        """
+        if digest is not None:
+            self.digest = digest
+            self.fields = fields
+        if self.validators is not None:
+            self.etag, self.last_modified = self.validators
+            self.validators = None
+        if self.pending_signature is not None:
+            self.signature = self.pending_signature
+            self.pending_signature = None
+        self.failing = False
+
+    def discard(self):
+        """Forget a payload that was not applied, fetch it again soon."""
+        self.validators = None
+        self.pending_signature = None
+        self._next_fetch = 0
 
-                new_state = round(rain, 2)
 
-            elif dev.type == 'rain_rate':
-                rate = float(self.data[10])
+class ClientrawData(object):
+    """Get the latest data and updates the states.
 
-                if not self.hass.config.units.is_metric:
-                    rate = rate * 0.0393700787
+    One instance exists per url and is shared by every platform entry
+    pointing at it, so the file is fetched and parsed once per interval.
+    The url can also be a local file, which is checked for changes every
+    second, or an udp:// or tcp:// address the station pushes to.
 
-                new_state = round(rate, 2)
+    Files next to clientraw.txt are fetched alongside it, concurrently
+    and at their own interval, when a monitored condition needs them.
+    """
 
-            elif dev.type == 'temp':
-                temperature = float(self.data[4])
+    def __init__(self, hass, url, interval, devices, history=None,
+                 file_intervals=None, replay_speed=DEFAULT_REPLAY_SPEED,
+                 aggregates=()):
+        """Initialize the data object.
 
-                if not self.hass.config.units.is_metric:
-                    temperature = convert_temperature(
-                        temperature, TEMP_CELSIUS, TEMP_FAHRENHEIT)
+        Aggregates are entities publishing all their types at once.
+        """
+        self._url = url
+        self.aggregates = list(aggregates)
+        self._replay_speed = replay_speed
+        self._replay = None
+        self.history = history
+        self.devices = list(devices)
+        self.diagnostics = []
+        self.hass = hass
+        self._file_intervals = file_intervals or {}
+        self._decoder = None
+        self._server = None
+        self.publish_time = None
+        self.fetch_latency = None
+        self.payload_bytes = None
+        self.parse_time = None
+        self.last_success = None
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.windows = {}
+        self.options = {}
+
+        poll_interval = interval * 60
+        retry_interval = None
+        parsed = urlparse(url)
+        if parsed.scheme in SOURCE_HTTP:
+            self._source = parsed.scheme
+            self._fetch = self._async_fetch_http
+            location = url
+        elif parsed.scheme in SOURCE_PUSH:
+            self._source = parsed.scheme
+            self._fetch = None
+            location = url
+        elif parsed.scheme == SOURCE_REPLAY:
+            self._source = SOURCE_REPLAY
+            self._fetch = None
+            location = parsed.path
+        else:
+            self._source = SOURCE_FILE
+            self._fetch = self._async_fetch_file
+            location = parsed.path if parsed.scheme else url
+            # A file caught halfway through being written reads fine a
+            # moment later, there is no server to back off from
+            poll_interval = retry_interval = FILE_POLL_INTERVAL
+
+        self.files = {
+            CLIENTRAW: ClientrawFile(
+                location, CLIENTRAW_FILES[CLIENTRAW][1], None)}
+        self.poller = ClientrawPoller(hass, poll_interval, self.async_update,
+                                      self._async_update_diagnostics,
+                                      retry_interval)
+        self._compile_decoder()
 
-                new_state = round(temperature, 2)
+    @property
+    def url(self):
+        """Return the url the data comes from."""
+        return self._url
 
-            elif dev.type == 'wind_speed':
-                speed = float(self.data[1])
+    @property
+    def data(self):
+        """Return the last parsed clientraw.txt fields."""
+        return self.files[CLIENTRAW].fields
+
+    def _compile_decoder(self):
+        """Compile the decoder for all registered devices."""
+        self._decoder = ClientrawDecoder(
+            [dev.type for dev in self.devices] +
+            [sensor_type for aggregate in self.aggregates
+             for sensor_type in aggregate.types],
+            self.hass.config.units.is_metric,
+            {dev.type: dev.spec for dev in self.devices})
+
+        for position in self._decoder.windows - set(self.windows):
+            self.windows[position] = WINDOW_KINDS[position[1]](position[3])
+
+        for file in self._decoder.files - set(self.files):
+            if self._fetch is None:
+                _LOGGER.warning("%s can't be received over %s",
+                                CLIENTRAW_FILES[file][0], self._source)
+                continue
+
+            name, min_fields, interval = CLIENTRAW_FILES[file]
+            interval = self._file_intervals.get(file, interval)
+            main = self.files[CLIENTRAW].location
+
+            if self._source == SOURCE_FILE:
+                location = os.path.join(os.path.dirname(main), name)
+            else:
+                location = urljoin(main, name)
+
+            self.files[file] = ClientrawFile(
+                location, min_fields, interval * 60)
+
+    def _fields(self):
+        """Return the last parsed fields of all files and windows."""
+        fields = {key: file.fields for key, file in self.files.items()}
+        fields[WINDOW] = self._window_values()
+        return fields
+
+    def _window_values(self):
+        """Return the current value of every time window."""
+        return {position: window.value
+                for position, window in self.windows.items()}
+
+    def _add_to_windows(self, timestamp, fields):
+        """Add a clientraw.txt sample to the time windows."""
+        for position, window in self.windows.items():
+            try:
+                value = float(fields[position[2]])
+            except ValueError:
+                continue
+            # History keeps NaN for unparsed fields, one would poison the
+            # running sums for good
+            if math.isfinite(value):
+                window.add(timestamp, value)
+
+    async def async_add_devices(self, devices, interval, aggregates=()):
+        """Register devices of another platform entry with the same url."""
+        self.devices.extend(devices)
+        self.aggregates.extend(aggregates)
+        self.poller.async_set_interval(interval * 60)
+        self._compile_decoder()
 
-                if self.hass.config.units.is_metric:
-                    new_state = speed * 1.85166
-                else:
-                    new_state = speed * 1.1507794
+        try:
+            states = self._decoder.decode(self._fields())
+        except (IndexError, ValueError) as err:
+            _LOGGER.error("Error decoding %s: %s", self._url, err)
+            return
 
-                new_state = round(speed, 2)
+        self._async_update_devices(devices, states, aggregates)
 
-            elif dev.type == 'wind_gust':
-                gust = float(self.data[2])
+    async def async_start(self):
+        """Start polling or listening for pushed data."""
+        if self.history is not None:
+            await self._async_restore()
 
-                if self.hass.config.units.is_metric:
-                    new_state = gust * 1.85166
-                else:
-                    new_state = gust * 1.1507794
+        if self._fetch is not None:
+            await self.poller.async_start()
+            return
 
-                new_state = round(gust, 2)
+        if self._source == SOURCE_REPLAY:
+            self._replay = self.hass.async_create_task(self._async_replay())
+            return
+
+        parsed = urlparse(self._url)
+        host = parsed.hostname or '0.0.0.0'
+
+        try:
+            if self._source == 'udp':
+                self._server, _ = \
+                    await self.hass.loop.create_datagram_endpoint(
+                        lambda: ClientrawDatagramProtocol(self),
+                        local_addr=(host, parsed.port))
+            else:
+                self._server = await asyncio.start_server(
+                    self._async_handle_connection, host, parsed.port)
+        except OSError as err:
+            _LOGGER.error("Unable to listen on %s: %s", self._url, err)
+            return
 
-            elif dev.type == 'pressure':
-                pressure = float(self.data[6])
+        _LOGGER.info("Listening for clientraw data on %s", self._url)
 
-                if not self.hass.config.units.is_metric:
-                    pressure = round(convert_pressure(
-                        pressure, PRESSURE_HPA, PRESSURE_INHG), 2)
+    async def _async_restore(self):
+        """Open the history and restore the last sample."""
+        try:
+            await self.hass.async_add_executor_job(self.history.open)
+        except (OSError, ValueError) as err:
+            _LOGGER.error("Unable to open history %s: %s",
+                          self.history.path, err)
+            self.history = None
+            return
 
-                new_state = round(pressure, 2)
+        last = self.history.last()
+        if last is None:
+            return
 
-            elif dev.type == 'wind_degrees':
-                new_state = float(self.data[3])
+        try:
+            if self.windows:
+                since = last[0] - max(
+                    window.seconds for window in self.windows.values())
+                for timestamp, fields in self.history.samples(since):
+                    self._add_to_windows(timestamp, fields)
+
+            states = self._decoder.decode(
+                {CLIENTRAW: last[1], WINDOW: self._window_values()})
+        except (IndexError, ValueError) as err:
+            _LOGGER.debug("Unable to restore from history: %s", err)
+            return
 
-            elif dev.type == 'wind_dir':
-                direction = float(self.data[3])
-                val = int((direction / 22.5) + .5)
-                arr = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
-                       "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
-                new_state = arr[(val % 16)]
+        self.files[CLIENTRAW].fields = last[1]
+        self._async_update_devices(self.devices, states, self.aggregates)
 
-            elif dev.type == 'humidity':
-                new_state = float(self.data[5])
+    def history_states(self, since=0):
+        """Return timestamp and decoded states of stored samples."""
+        if self.history is None or self.history.count == 0:
+            return []
 
-            elif dev.type == 'cloud_height':
-                height = float(self.data[73])
+        samples = []
+        for timestamp, fields in self.history.samples(since):
+            try:
+                samples.append(
+                    (timestamp, self._decoder.decode({CLIENTRAW: fields})))
+            except (IndexError, ValueError):
+                continue
 
-                if not self.hass.config.units.is_metric:
-                    height = convert_distance(
-                        height, LENGTH_METERS, LENGTH_FEET)
+        return samples
 
-                new_state = round(height, 2)
+    @callback
+    def async_stop(self, *_):
+        """Stop polling or listening."""
+        self.poller.stop()
 
-            elif dev.type == 'dewpoint':
-                temperature = float(self.data[72])
+        if self.history is not None:
+            self.history.close()
 
-                if not self.hass.config.units.is_metric:
-                    temperature = convert_temperature(
-                        temperature, TEMP_CELSIUS, TEMP_FAHRENHEIT)
+        if self._server is not None:
+            self._server.close()
+            self._server = None
 
-                new_state = round(temperature, 2)
+        if self._replay is not None:
+            self._replay.cancel()
+            self._replay = None
 
-            elif dev.type == 'heat_index':
-                temperature = float(self.data[112])
+    async def _async_replay(self):
+        """Feed recorded snapshots through the parser."""
+        archive = ClientrawArchive(self.files[CLIENTRAW].location)
 
-                if not self.hass.config.units.is_metric:
-                    temperature = convert_temperature(
-                        temperature, TEMP_CELSIUS, TEMP_FAHRENHEIT)
+        try:
+            await self.hass.async_add_executor_job(archive.open)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as err:
+            _LOGGER.error("Unable to open replay %s: %s",
+                          archive.path, err)
+            return
 
-                new_state = round(temperature, 2)
+        _LOGGER.info("Replaying %d snapshots from %s at %sx speed",
+                     len(archive.snapshots), archive.path,
+                     self._replay_speed)
 
-            elif dev.type == 'humidex':
-                temperature = float(self.data[44])
+        try:
+            previous = None
+            for timestamp, member in archive.snapshots:
+                if previous is not None and timestamp > previous:
+                    await asyncio.sleep(
+                        (timestamp - previous) / self._replay_speed)
+                previous = timestamp
+
+                try:
+                    body = await self.hass.async_add_executor_job(
+                        archive.read, member)
+                except (OSError, tarfile.TarError, zipfile.BadZipFile,
+                        KeyError) as err:
+                    _LOGGER.error("Unable to read %s: %s", member, err)
+                    continue
+
+                await self.async_process_push(body, timestamp)
+        finally:
+            await self.hass.async_add_executor_job(archive.close)
+
+        _LOGGER.info("Replay of %s finished", archive.path)
+
+    def add_diagnostics(self, diagnostics):
+        """Register diagnostic sensors."""
+        for diagnostic in diagnostics:
+            diagnostic.weather = self
+        self.diagnostics.extend(diagnostics)
+
+    @callback
+    def _async_update_diagnostics(self):
+        """Write changed diagnostic states."""
+        for diagnostic in self.diagnostics:
+            diagnostic.async_update_from_weather()
+
+    def latency_histogram(self):
+        """Return count of kept fetch latencies per bucket in ms."""
+        histogram = dict.fromkeys(LATENCY_BUCKETS + ('inf',), 0)
+
+        for latency in self.latencies:
+            for bucket in LATENCY_BUCKETS:
+                if latency <= bucket:
+                    histogram[bucket] += 1
+                    break
+            else:
+                histogram['inf'] += 1
+
+        return histogram
+
+    def log_latency_histogram(self):
+        """Log the fetch latency histogram."""
+        _LOGGER.info("Fetch latency of %s over last %d polls: %s",
+                     self._url, len(self.latencies), ', '.join(
+                         '<={}ms: {}'.format(bucket, count)
+                         for bucket, count in
+                         self.latency_histogram().items()))
+
+    async def async_update(self):
+        """Get the latest data, return False if it should be retried."""
+        now = time.monotonic()
+        due = [key for key, file in self.files.items() if file.due(now)]
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(self._fetch(self.files[key]) for key in due))
+        self.fetch_latency = (time.perf_counter() - start) * 1000
+        self.latencies.append(self.fetch_latency)
+
+        bodies = {}
+        success = True
+        for key, (fetched, body) in zip(due, results):
+            if fetched:
+                self.files[key].fetched(now)
+            if body is not None:
+                bodies[key] = body
+            elif not fetched and key == CLIENTRAW:
+                success = False
+
+        if bodies:
+            success = await self.async_process(bodies) and success
+
+        return success
+
+    async def _async_fetch_http(self, file):
+        """Download a file, body is None if it has not changed."""
+        headers = {}
+        if file.etag is not None:
+            headers[IF_NONE_MATCH] = file.etag
+        if file.last_modified is not None:
+            headers[IF_MODIFIED_SINCE] = file.last_modified
 
-                if not self.hass.config.units.is_metric:
-                    temperature = convert_temperature(
-                        temperature, TEMP_CELSIUS, TEMP_FAHRENHEIT)
+        try:
+            websession = async_get_clientsession(self.hass)
+            with async_timeout.timeout(FETCH_TIMEOUT, loop=self.hass.loop):
+                resp = await websession.get(file.location, headers=headers)
+                if resp.status == 304:
+                    _LOGGER.debug("%s not modified", file.location)
+                    return True, None
+                if resp.status != 200:
+                    _LOGGER.error("%s returned %s", resp.url, resp.status)
+                    return False, None
+                body = await resp.read()
 
-                new_state = round(temperature, 2)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as err:
+            _LOGGER.error("Error fetching %s: %s", file.location, err)
+            return False, None
 
-            elif dev.type == 'forecast':
-                val = int(self.data[15])
-                arr = ["sunny", "clearnight", "cloudy", "cloudy2",
-                       "night cloudy", "dry", "fog", "haze", "heavyrain",
-                       "mainlyfine", "mist", "night fog", "night heavyrain",
-                       "night overcast", "night rain", "night showers",
-                       "night snow", "night", "thunder", "overcast",
-                       "partlycloudy", "rain", "rain2", "showers2", "sleet",
-                       "sleetshowers", "snow", "snowmelt", "snowshowers2",
-                       "sunny", "thundershowers", "thundershowers2",
-                       "thunderstorms", "tornado", "windy", "stopped",
-                       "rainning", "wind + rain"]
-                new_state = arr[(val)] if val < len(arr) else "unknown"
+        # Kept once the body is applied, a body that fails to parse must
+        # not be answered with 304 on the next poll
+        file.validators = (resp.headers.get(ETAG),
+                           resp.headers.get(LAST_MODIFIED))
+        return True, body
 
+    async def _async_fetch_file(self, file):
+        """Read a local file, body is None if it has not changed."""
+        try:
+            stat = await self.hass.async_add_executor_job(
+                os.stat, file.location)
+            signature = (stat.st_mtime_ns, stat.st_size)
+
+            if signature == file.signature:
+                return True, None
+
+            body = await self.hass.async_add_executor_job(
+                _read_file, file.location)
+        except OSError as err:
+            # A local file is retried every second, only the start of an
+            # outage is an error
+            if file.failing:
+                _LOGGER.debug("Error reading %s: %s", file.location, err)
+            else:
+                _LOGGER.error("Error reading %s: %s", file.location, err)
+            file.failing = True
+            return False, None
+
+        # Kept once the body is applied, like the http validators
+        file.pending_signature = signature
+        return True, body
+
+    async def _async_handle_connection(self, reader, writer):
+        """Read data pushed over a tcp connection."""
+        try:
+            with async_timeout.timeout(FETCH_TIMEOUT, loop=self.hass.loop):
+                body = await reader.read(MAX_PUSH_SIZE)
+                while not reader.at_eof() and len(body) < MAX_PUSH_SIZE:
+                    body += await reader.read(MAX_PUSH_SIZE - len(body))
+        except (asyncio.TimeoutError, OSError) as err:
+            _LOGGER.error("Error receiving data on %s: %s", self._url, err)
+            return
+        finally:
+            writer.close()
+
+        await self.async_process_push(body)
+
+    async def async_process_push(self, body, timestamp=None):
+        """Parse a pushed payload and update the diagnostics."""
+        await self.async_process(body, timestamp)
+        self._async_update_diagnostics()
+
+    async def async_process(self, bodies, timestamp=None):
+        """Parse raw payloads and update the devices.
+
+        Bodies maps file to its payload, a bare payload is clientraw.txt.
+        Timestamp of the sample defaults to now.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if not isinstance(bodies, dict):
+            bodies = {CLIENTRAW: bodies}
+
+        start = time.perf_counter()
+        self.payload_bytes = sum(len(body) for body in bodies.values())
+        success = True
+        parsed = {}
+        fields = self._fields()
+        for key, body in bodies.items():
+            file = self.files[key]
+            try:
+                result = file.parse(body)
+            except ValueError as err:
+                if file.failing:
+                    _LOGGER.debug("Error parsing %s: %s", file.location, err)
+                else:
+                    _LOGGER.error("Error parsing %s: %s", file.location, err)
+                file.failing = True
+                file.discard()
+                # Only a bad clientraw.txt fails the poll, conditions of
+                # the other files keep their values until the next fetch
+                if key == CLIENTRAW:
+                    success = False
+                continue
+
+            if result is None:
+                file.commit()
+            else:
+                parsed[key] = result
+                fields[key] = result[1]
+
+        if not parsed:
+            if success:
+                _LOGGER.debug("%s content unchanged", self._url)
+            return success
+
+        if CLIENTRAW in parsed and self.windows:
+            self._add_to_windows(timestamp, fields[CLIENTRAW])
+            fields[WINDOW] = self._window_values()
+
+        states = self._decoder.decode(fields)
+
+        for key, (digest, file_fields) in parsed.items():
+            self.files[key].commit(digest, file_fields)
+
+        self.parse_time = (time.perf_counter() - start) * 1000
+        if success:
+            self.last_success = dt_util.utcnow()
+
+        if self.history is not None and CLIENTRAW in parsed:
+            self.history.append(timestamp, self.data)
+
+        self._async_update_devices(self.devices, states, self.aggregates)
+        return success
+
+    @callback
+    def _async_update_devices(self, devices, states, aggregates=()):
+        """Write decoded states of the devices in one pass."""
+        start = time.perf_counter()
+        now = time.monotonic()
+        written = 0
+
+        for dev in devices:
+            if dev.type not in states:
+                continue
+
+            new_state = states[dev.type]
             _LOGGER.debug("%s %s", dev.type, new_state)
 
             # pylint: disable=protected-access
-            if new_state != dev._state:
+            if dev.should_update(new_state, now):
                 dev._state = new_state
-                tasks.append(dev.async_update_ha_state())
+                if dev.hass is not None:
+                    dev._written_at = now
+                    dev.async_write_ha_state()
+                    written += 1
+
+        for aggregate in aggregates:
+            if aggregate.async_update_from_states(states):
+                written += 1
+
+        self.publish_time = time.perf_counter() - start
+        _LOGGER.debug("Published %d of %d states of %s in %.3f ms",
+                      written, len(devices), self._url,
+                      self.publish_time * 1000)
+
+
+class ClientrawDatagramProtocol(asyncio.DatagramProtocol):
+    """Receive clientraw data pushed over udp."""
 
-        if tasks:
-            await asyncio.wait(tasks, loop=self.hass.loop)
+    def __init__(self, weather):
+        """Initialize the protocol."""
+        self._weather = weather
 
-        async_call_later(self.hass, self._interval * 60, self.async_update)
+    def datagram_received(self, data, addr):
+        """Parse a received datagram."""
+        _LOGGER.debug("Received %d bytes from %s", len(data), addr)
+        self._weather.hass.async_create_task(
+            self._weather.async_process_push(data))
@@ -0,0 +1,157 @@
+import logging
+
+from homeassistant.components.weather import PLATFORM_SCHEMA, WeatherEntity
+from homeassistant.const import (
+    ATTR_ATTRIBUTION, CONF_NAME, TEMP_CELSIUS, TEMP_FAHRENHEIT)
+from homeassistant.core import callback
+
+from .sensor import (
+    CONF_ATTRIBUTION, CONF_INTERVAL, SENSOR_TYPES, STATION_SCHEMA,
+    async_setup_station)
+
+__version__ = '1.0.0'
+
+_LOGGER = logging.getLogger(__name__)
+
+# Every condition read straight from clientraw.txt
+WEATHER_TYPES = [sensor_type for sensor_type, sensor in SENSOR_TYPES.items()
+                 if isinstance(sensor[4], int)]
+
+# Forecast icon name: Home Assistant condition
+CONDITIONS = {
+    "sunny": "sunny",
+    "clearnight": "clear-night",
+    "cloudy": "cloudy",
+    "cloudy2": "cloudy",
+    "night cloudy": "cloudy",
+    "dry": "sunny",
+    "fog": "fog",
+    "haze": "fog",
+    "heavyrain": "pouring",
+    "mainlyfine": "partlycloudy",
+    "mist": "fog",
+    "night fog": "fog",
+    "night heavyrain": "pouring",
+    "night overcast": "cloudy",
+    "night rain": "rainy",
+    "night showers": "rainy",
+    "night snow": "snowy",
+    "night": "clear-night",
+    "thunder": "lightning",
+    "overcast": "cloudy",
+    "partlycloudy": "partlycloudy",
+    "rain": "rainy",
+    "rain2": "rainy",
+    "showers2": "rainy",
+    "sleet": "snowy-rainy",
+    "sleetshowers": "snowy-rainy",
+    "snow": "snowy",
+    "snowmelt": "snowy-rainy",
+    "snowshowers2": "snowy",
+    "thundershowers": "lightning-rainy",
+    "thundershowers2": "lightning-rainy",
+    "thunderstorms": "lightning-rainy",
+    "tornado": "exceptional",
+    "windy": "windy",
+    "stopped": "cloudy",
+    "rainning": "rainy",
+    "wind + rain": "rainy",
+}
+
+PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(STATION_SCHEMA)
+
+
+async def async_setup_platform(hass, config, async_add_entities,
+                               discovery_info=None):
+    """Set up the Clientraw weather."""
+    _LOGGER.debug("Clientraw weather setup interval %s",
+                  config.get(CONF_INTERVAL))
+
+    weather = ClientrawWeather(
+        hass.config.units.is_metric, config.get(CONF_NAME))
+    async_add_entities([weather])
+    await async_setup_station(hass, config, [], aggregates=[weather])
+
+
+class ClientrawWeather(WeatherEntity):
+    """Representation of a whole clientraw station as one entity."""
+
+    def __init__(self, is_metric, name):
+        """Initialize the weather."""
+        self._name = name
+        self._is_metric = is_metric
+        self._states = {}
+        self.types = WEATHER_TYPES
+
+    @property
+    def name(self):
+        """Return the name of the weather."""
+        return self._name
+
+    @property
+    def should_poll(self):
+        """No polling needed."""
+        return False
+
+    @property
+    def condition(self):
+        """Return the current condition."""
+        return CONDITIONS.get(self._states.get('forecast'))
+
+    @property
+    def temperature(self):
+        """Return the temperature."""
+        return self._states.get('temp')
+
+    @property
+    def temperature_unit(self):
+        """Return the unit of measurement of the temperature."""
+        return TEMP_CELSIUS if self._is_metric else TEMP_FAHRENHEIT
+
+    @property
+    def pressure(self):
+        """Return the pressure."""
+        return self._states.get('pressure')
+
+    @property
+    def humidity(self):
+        """Return the humidity."""
+        return self._states.get('humidity')
+
+    @property
+    def wind_speed(self):
+        """Return the wind speed."""
+        return self._states.get('wind_speed')
+
+    @property
+    def wind_bearing(self):
+        """Return the wind bearing."""
+        return self._states.get('wind_degrees')
+
+    @property
+    def attribution(self):
+        """Return the attribution."""
+        return CONF_ATTRIBUTION
+
+    @property
+    def device_state_attributes(self):
+        """Return every parsed condition."""
+        attributes = dict(self._states)
+        attributes[ATTR_ATTRIBUTION] = CONF_ATTRIBUTION
+        return attributes
+
+    @callback
+    def async_update_from_states(self, states):
+        """Take the decoded states, return True if the entity was written."""
+        states = {sensor_type: states[sensor_type]
+                  for sensor_type in self.types if sensor_type in states}
+
+        if states == self._states:
+            return False
+
+        self._states = states
+        if self.hass is None:
+            return False
+
+        self.async_write_ha_state()
+        return True
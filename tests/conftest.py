@@ -0,0 +1,152 @@
+"""Fixtures shared by the custom component tests."""
+import asyncio
+import os
+import sys
+import types
+
+import pytest
+
+# The components are imported as top level packages, as Home Assistant
+# does from custom_components
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+
+class FakeClock(object):
+    """Stand-in for async_call_later firing on a simulated clock."""
+
+    def __init__(self):
+        """Initialize the clock at 0."""
+        self.now = 0
+        self.timers = []
+
+    def call_later(self, hass, delay, action):
+        """Schedule the action, return its remover."""
+        timer = [self.now + delay, action]
+        self.timers.append(timer)
+
+        def remove():
+            """Cancel the timer."""
+            if timer in self.timers:
+                self.timers.remove(timer)
+
+        return remove
+
+    async def run_until(self, end):
+        """Fire the timers due until end, in order."""
+        while self.timers:
+            timer = min(self.timers, key=lambda timer: timer[0])
+            if timer[0] > end:
+                break
+            self.timers.remove(timer)
+            self.now = timer[0]
+            result = timer[1](self.now)
+            if asyncio.iscoroutine(result):
+                await result
+        self.now = end
+
+
+@pytest.fixture
+def loop():
+    """Return a fresh event loop."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def clock():
+    """Return a fake clock for async_call_later."""
+    return FakeClock()
+
+
+class FakeBus(object):
+    """Event bus calling its listeners right away."""
+
+    def __init__(self):
+        """Initialize without listeners."""
+        self.listeners = []
+
+    def async_listen(self, event_type, listener):
+        """Call listener on events of event_type, return remover."""
+        entry = (event_type, listener)
+        self.listeners.append(entry)
+
+        def remove():
+            """Stop calling the listener."""
+            self.listeners.remove(entry)
+
+        return remove
+
+    def async_fire(self, event_type, data):
+        """Call the listeners of event_type with the event data."""
+        event = types.SimpleNamespace(event_type=event_type, data=data)
+        for listened, listener in list(self.listeners):
+            if listened == event_type:
+                listener(event)
+
+
+class FakeStates(object):
+    """State machine keeping states in a dict and firing state_changed."""
+
+    def __init__(self, bus):
+        """Initialize without states."""
+        self.bus = bus
+        self.states = {}
+
+    def get(self, entity_id):
+        """Return the state of the entity or None."""
+        return self.states.get(entity_id)
+
+    def async_all(self):
+        """Return all states."""
+        return list(self.states.values())
+
+    def async_entity_ids(self):
+        """Return all entity IDs."""
+        return list(self.states)
+
+    def async_set(self, entity_id, new_state, attributes=None,
+                  last_changed=None):
+        """Set the state of the entity, None removes it."""
+        old_state = self.states.pop(entity_id, None)
+        state = None
+        if new_state is not None:
+            state = self.states[entity_id] = types.SimpleNamespace(
+                entity_id=entity_id, state=new_state,
+                attributes=dict(attributes or {}),
+                last_changed=last_changed)
+        self.bus.async_fire('state_changed', {
+            'entity_id': entity_id,
+            'old_state': old_state,
+            'new_state': state,
+        })
+        return state
+
+
+class FakeHass(object):
+    """Minimal stand-in of the hass object the components use."""
+
+    def __init__(self, loop, is_metric=True):
+        """Initialize on the event loop."""
+        self.loop = loop
+        self.data = {}
+        self.config = types.SimpleNamespace(
+            units=types.SimpleNamespace(is_metric=is_metric))
+        self.bus = FakeBus()
+        self.states = FakeStates(self.bus)
+        self.jobs = []
+
+    def async_add_job(self, target):
+        """Collect scheduled jobs."""
+        self.jobs.append(target)
+
+    async def async_add_executor_job(self, target, *args):
+        """Run the job right away."""
+        return target(*args)
+
+
+@pytest.fixture
+def hass(loop):
+    """Return a fake hass on the test loop."""
+    return FakeHass(loop)
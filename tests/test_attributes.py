@@ -0,0 +1,287 @@
+"""Tests of the attributes sensor platform."""
+import asyncio
+import random
+import types
+from datetime import timedelta
+
+import pytest
+
+pytest.importorskip('homeassistant')
+
+from attributes import sensor  # noqa: E402
+
+
+def brute_force(values, threshold):
+    """Return min, max, mean and count below of the values by rescanning."""
+    if not values:
+        return (None, None), (None, None), None, 0
+    smallest = min(values.items(), key=lambda item: (item[1], item[0]))
+    largest = max(values.items(), key=lambda item: (item[1], item[0]))
+    return ((smallest[1], smallest[0]), (largest[1], largest[0]),
+            sum(values.values()) / len(values),
+            sum(1 for value in values.values() if value < threshold))
+
+
+def test_group_matches_brute_force():
+    """Incremental aggregates equal a rescan after every change."""
+    rand = random.Random(4)
+    group = sensor.AttributeGroup(threshold=20)
+    values = {}
+
+    for _ in range(2000):
+        entity_id = 'sensor.s{}'.format(rand.randrange(30))
+        value = rand.choice([None, rand.randrange(100)])
+        group.update(entity_id, value)
+        if value is None:
+            values.pop(entity_id, None)
+        else:
+            values[entity_id] = value
+
+        minimum, maximum, mean, below = brute_force(values, 20)
+        assert group.minimum()[0] == minimum[0]
+        assert group.maximum()[0] == maximum[0]
+        assert values.get(group.minimum()[1]) == minimum[0]
+        assert values.get(group.maximum()[1]) == maximum[0]
+        assert group.mean() == pytest.approx(mean)
+        assert group.count_below() == below
+        assert len(group) == len(values)
+
+
+def test_group_update_reports_changes():
+    """Setting the same value again is not a change."""
+    group = sensor.AttributeGroup()
+
+    assert group.update('sensor.a', 5)
+    assert not group.update('sensor.a', 5)
+    assert group.update('sensor.a', None)
+    assert not group.update('sensor.a', None)
+    assert group.minimum() == (None, None)
+    assert group.mean() is None
+
+
+def state(entity_id, attributes=None):
+    """Return a minimal state for the selector."""
+    return types.SimpleNamespace(entity_id=entity_id, state='on',
+                                 attributes=attributes or {},
+                                 last_changed=None)
+
+
+@pytest.mark.parametrize('kwargs, selected, ignored', [
+    ({'entities': ['sensor.a']}, ['sensor.a'], ['sensor.b']),
+    ({'entities': ['sensor.door_*']}, ['sensor.door_1'],
+     ['sensor.window_1', 'binary_sensor.door_1']),
+    ({'entities': [], 'domains': ['zwave']}, ['zwave.node_2'],
+     ['sensor.node_2']),
+    ({'entities': [], 'regex': sensor.re.compile('_[0-9]+$')},
+     ['light.hall_12'], ['light.hall']),
+])
+def test_selector_matches(kwargs, selected, ignored):
+    """Entities are picked by ID, glob, domain or regex."""
+    selector = sensor.EntitySelector(**kwargs)
+
+    for entity_id in selected:
+        assert selector.matches(entity_id, state(entity_id))
+    for entity_id in ignored:
+        assert not selector.matches(entity_id, state(entity_id))
+
+
+def test_selector_attribute():
+    """With an attribute only states carrying it are selected."""
+    selector = sensor.EntitySelector([], attribute='battery_level')
+
+    assert selector.dynamic
+    assert selector.matches(
+        'lock.front', state('lock.front', {'battery_level': 80}))
+    assert not selector.matches('lock.front', state('lock.front'))
+    assert not selector.matches('lock.front', None)
+
+
+def test_selector_explicit_is_static():
+    """Explicit IDs only don't need watching all entities."""
+    selector = sensor.EntitySelector(['sensor.a', 'sensor.b'])
+
+    assert not selector.dynamic
+    assert selector.explicit == ['sensor.a', 'sensor.b']
+
+
+def test_selector_exclude_keeps_explicit():
+    """Excluded entities are only selected when listed explicitly."""
+    exclude = {'sensor.a_battery', 'sensor.b_battery'}
+    selector = sensor.EntitySelector(
+        ['sensor.a_battery'], domains=['sensor'], exclude=exclude)
+
+    assert selector.matches('sensor.a_battery', state('sensor.a_battery'))
+    assert not selector.matches(
+        'sensor.b_battery', state('sensor.b_battery'))
+    assert selector.matches('sensor.c', state('sensor.c'))
+
+
+@pytest.mark.parametrize('value, icon', [
+    (100, 'mdi:battery'),
+    ('55', 'mdi:battery-50'),
+    (5, 'mdi:battery-outline'),
+    (-3, 'mdi:battery-outline'),
+    (130, 'mdi:battery'),
+    (float('inf'), 'mdi:battery-unknown'),
+    (float('nan'), 'mdi:battery-unknown'),
+    ('low', 'mdi:battery-unknown'),
+    (None, 'mdi:battery-unknown'),
+])
+def test_battery_icon(value, icon):
+    """Levels map to their icon, anything else is unknown."""
+    assert sensor.battery_icon(value) == icon
+
+
+def test_dispatcher_routes_and_unsubscribes(hass):
+    """Actions are called for their entity only and unsubscribe cleanly."""
+    dispatcher = sensor.get_dispatcher(hass)
+    calls = []
+    remove_a = dispatcher.async_track(
+        'sensor.a', lambda *args: calls.append(('a',) + args[:1]))
+    remove_all = dispatcher.async_track(
+        sensor.MATCH_ALL, lambda *args: calls.append(('all',) + args[:1]))
+
+    assert len(hass.bus.listeners) == 1
+
+    hass.states.async_set('sensor.a', 1)
+    hass.states.async_set('sensor.b', 2)
+    assert calls == [('a', 'sensor.a'), ('all', 'sensor.a'),
+                     ('all', 'sensor.b')]
+
+    remove_a()
+    remove_a()
+    remove_all()
+    assert hass.bus.listeners == []
+
+
+def make_sensor(hass, min_interval):
+    """Return a sensor of the battery level of sensor.source."""
+    return sensor.AttributeSensor(
+        hass, 'source_battery_level', 'Source', '%', 'battery_level',
+        sensor.attribute_accessor('battery_level'), None, 'sensor.source',
+        min_interval)
+
+
+@pytest.fixture
+def coalescing(loop, hass, clock, monkeypatch):
+    """Run the sensor on the fake clock without restored state."""
+    @asyncio.coroutine
+    def no_last_state(self):
+        return None
+
+    monkeypatch.setattr(sensor, 'async_call_later', clock.call_later)
+    monkeypatch.setattr(hass.loop, 'time', lambda: clock.now)
+    monkeypatch.setattr(
+        sensor.AttributeSensor, 'async_get_last_state', no_last_state)
+    yield
+    for job in hass.jobs:
+        job.close()
+
+
+def test_min_interval_coalesces_writes(loop, hass, clock, coalescing):
+    """Changes within min_interval are written once, at its end."""
+    entity = make_sensor(hass, timedelta(seconds=10))
+    loop.run_until_complete(entity.async_added_to_hass())
+
+    for clock.now, level in [(0, 90), (2, 89), (5, 88), (7, 87)]:
+        hass.states.async_set('sensor.source', 'on', {'battery_level': level})
+
+    assert len(hass.jobs) == 1
+    assert len(clock.timers) == 1
+
+    loop.run_until_complete(clock.run_until(10))
+    assert len(hass.jobs) == 2
+    assert entity._source_state.attributes['battery_level'] == 87
+
+    # A change well after the window is written right away
+    clock.now = 30
+    hass.states.async_set('sensor.source', 'on', {'battery_level': 86})
+    assert len(hass.jobs) == 3
+    assert clock.timers == []
+
+
+def test_without_min_interval_every_change_is_written(loop, hass, clock,
+                                                      coalescing):
+    """Without min_interval each change of the inputs is written."""
+    entity = make_sensor(hass, None)
+    loop.run_until_complete(entity.async_added_to_hass())
+
+    for level in (90, 89, 89, 88):
+        hass.states.async_set('sensor.source', 'on', {'battery_level': level})
+
+    assert len(hass.jobs) == 3
+    assert clock.timers == []
+
+
+def test_pending_write_cancelled_on_removal(loop, hass, clock, coalescing):
+    """Removing the sensor drops the coalesced write."""
+    entity = make_sensor(hass, timedelta(seconds=10))
+    loop.run_until_complete(entity.async_added_to_hass())
+    hass.states.async_set('sensor.source', 'on', {'battery_level': 90})
+    clock.now = 1
+    hass.states.async_set('sensor.source', 'on', {'battery_level': 89})
+
+    loop.run_until_complete(entity.async_will_remove_from_hass())
+    assert clock.timers == []
+    assert hass.bus.listeners == []
+
+
+def test_platform_skips_its_own_sensors(loop, hass):
+    """A domain wide selection doesn't create sensors of its sensors."""
+    hass.states.async_set('sensor.lock', 'on', {'battery_level': 80})
+    config = sensor.PLATFORM_SCHEMA({
+        'platform': 'attributes',
+        'attribute': 'battery_level',
+        'domains': 'sensor',
+    })
+    added = []
+
+    def add_devices(devices):
+        added.extend(devices)
+        for device in devices:
+            hass.states.async_set(device.entity_id, '80',
+                                  {'battery_level': 80})
+
+    assert loop.run_until_complete(
+        sensor.async_setup_platform(hass, config, add_devices))
+    hass.states.async_set('sensor.door', 'on', {'battery_level': 60})
+
+    assert [device.entity_id for device in added] == [
+        'sensor.lock_battery_level', 'sensor.door_battery_level']
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2019-05-01T12:30:15.5+00:00', '2019-05-01 12:30:15'),
+    (1556713815.5, '2019-05-01 12:30:15'),
+    (float('nan'), None),
+    (1e30, None),
+    (['2019-05-01'], None),
+    ('yesterday', None),
+    (True, None),
+])
+def test_time_attribute_values(monkeypatch, value, expected):
+    """Strings and timestamps are formatted, anything else is None."""
+    monkeypatch.setattr(sensor.dt_util, 'DEFAULT_TIME_ZONE',
+                        sensor.dt_util.UTC)
+    access = sensor.attribute_accessor('last_triggered', '%Y-%m-%d %H:%M:%S')
+    source = state('automation.a', {'last_triggered': value})
+
+    assert access(source) == expected
+
+
+def test_aggregate_ids_use_friendly_name(loop, hass):
+    """Blocks aggregating the same attribute get distinct entity IDs."""
+    added = []
+    for name in ('Door locks', 'Remotes'):
+        config = sensor.PLATFORM_SCHEMA({
+            'platform': 'attributes',
+            'friendly_name': name,
+            'attribute': 'battery_level',
+            'entity_regex': '^lock\\.',
+            'aggregates': ['min'],
+        })
+        assert loop.run_until_complete(
+            sensor.async_setup_platform(hass, config, added.extend))
+
+    assert [device.entity_id for device in added] == [
+        'sensor.door_locks_min', 'sensor.remotes_min']
@@ -0,0 +1,262 @@
+"""Tests of the clientraw sensor platform."""
+import asyncio
+import types
+
+import pytest
+
+pytest.importorskip('homeassistant')
+
+from clientraw import sensor  # noqa: E402
+
+HOUR = 3600
+
+
+@pytest.fixture
+def poll_log(monkeypatch, clock):
+    """Patch the poller timer with the fake clock, return poll times."""
+    monkeypatch.setattr(sensor, 'async_call_later', clock.call_later)
+    return []
+
+
+def make_poller(clock, poll_log, interval, success=True, **kwargs):
+    """Return a poller logging the clock time of every poll."""
+    async def action():
+        poll_log.append(clock.now)
+        return success
+
+    return sensor.ClientrawPoller(None, interval, action, **kwargs)
+
+
+@pytest.mark.parametrize('interval, most', [(60, 61), (15 * 60, 5)])
+def test_poller_successful_polls_per_hour(loop, clock, poll_log, interval,
+                                          most):
+    """A healthy station is polled once per interval."""
+    poller = make_poller(clock, poll_log, interval)
+    loop.run_until_complete(poller.async_start())
+    loop.run_until_complete(clock.run_until(HOUR))
+
+    assert len(poll_log) == most
+    assert len(clock.timers) == 1
+
+
+def test_poller_failing_polls_per_hour(loop, clock, poll_log):
+    """A station that always fails is polled less and less often."""
+    poller = make_poller(clock, poll_log, 60, success=False)
+    loop.run_until_complete(poller.async_start())
+    loop.run_until_complete(clock.run_until(HOUR))
+
+    # Shortest jittered delays are 60, 120, 240, 480 and then 900 s
+    assert len(poll_log) <= 9
+    assert poller.failures == len(poll_log)
+    assert len(clock.timers) == 1
+
+
+def test_poller_retry_interval(loop, clock, poll_log):
+    """With a retry interval failures don't back off."""
+    poller = make_poller(clock, poll_log, 1, success=False,
+                         retry_interval=1)
+    loop.run_until_complete(poller.async_start())
+    loop.run_until_complete(clock.run_until(60))
+
+    assert len(poll_log) == 61
+
+
+def test_poller_stop_during_poll(loop, clock, poll_log):
+    """A poll in flight at stop doesn't schedule another one."""
+    poller = None
+
+    async def action():
+        poll_log.append(clock.now)
+        poller.stop()
+        return True
+
+    poller = sensor.ClientrawPoller(None, 60, action)
+    loop.run_until_complete(poller.async_start())
+    loop.run_until_complete(clock.run_until(HOUR))
+
+    assert poll_log == [0]
+    assert clock.timers == []
+
+
+def test_poller_shorter_interval_rearms(loop, clock, poll_log):
+    """Shortening the interval re-arms the pending poll."""
+    poller = make_poller(clock, poll_log, 15 * 60)
+    loop.run_until_complete(poller.async_start())
+    poller.async_set_interval(60)
+    loop.run_until_complete(clock.run_until(120))
+
+    assert poll_log == [0, 60, 120]
+
+
+def test_decoder_skips_nan_history_fields():
+    """Fields history couldn't parse are left out of the states."""
+    fields = [0.0] * 120
+    fields[4] = float('nan')
+    fields[5] = 65.0
+    decoder = sensor.ClientrawDecoder(['temp', 'humidity'], True)
+
+    assert decoder.decode({sensor.CLIENTRAW: fields}) == {'humidity': 65.0}
+
+
+def test_field_sensor_type_keeps_sensor_types_untouched():
+    """Configured fields decode from their own spec."""
+    sensor_type, spec = sensor.field_sensor_type({
+        sensor.CONF_NAME: 'Field', sensor.CONF_FILE: 'clientrawdaily',
+        sensor.CONF_INDEX: 2, sensor.CONF_ICON: 'mdi:eye'})
+    decoder = sensor.ClientrawDecoder(
+        [sensor_type], True, {sensor_type: spec})
+
+    assert sensor_type not in sensor.SENSOR_TYPES
+    assert decoder.decode({'clientrawdaily': ['12345', '1', '2.5']}) == {
+        sensor_type: 2.5}
+
+
+def test_file_failed_fetch_is_retried():
+    """The next fetch is planned only after a successful one."""
+    file = sensor.ClientrawFile('clientrawdaily.txt', 2, 3600)
+
+    assert file.due(0)
+    assert file.due(60)
+    file.fetched(60)
+    assert not file.due(120)
+    file.discard()
+    assert file.due(120)
+
+
+CLIENTRAW_BODY = ('12345 3 5 180 21.3 65 1013 1 0 0 0 ' +
+                  ' '.join(['1'] * 120)).encode()
+
+
+def test_file_parse_rejects_truncated_and_garbage():
+    """Payloads with too few fields are rejected."""
+    file = sensor.ClientrawFile('clientraw.txt', 115, None)
+
+    with pytest.raises(ValueError):
+        file.parse(CLIENTRAW_BODY[:100])
+    with pytest.raises(ValueError):
+        file.parse(b'\xff\xfe<html>Not Found</html>')
+
+    digest, fields = file.parse(CLIENTRAW_BODY)
+    assert fields[4] == '21.3'
+    file.commit(digest, fields)
+    assert file.parse(CLIENTRAW_BODY) is None
+
+
+def test_decoder_skips_undecodable_field_only():
+    """A bad field only drops the condition reading it."""
+    fields = CLIENTRAW_BODY.decode().split(' ')
+    fields[5] = '---'
+    decoder = sensor.ClientrawDecoder(['temp', 'humidity'], True)
+
+    assert decoder.decode({sensor.CLIENTRAW: fields}) == {'temp': 21.3}
+    assert decoder.failed == {'humidity'}
+
+
+@pytest.fixture
+def station(loop, hass, monkeypatch):
+    """Serve clientraw.txt from a local aiohttp server."""
+    aiohttp = pytest.importorskip('aiohttp')
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    async def clientraw(request):
+        """Answer like a station, with an ETag."""
+        if request.headers.get('If-None-Match') == '"1"':
+            return web.Response(status=304)
+        return web.Response(body=CLIENTRAW_BODY, headers={'ETag': '"1"'})
+
+    async def slow(request):
+        """Send the headers, then stall the body."""
+        response = web.StreamResponse()
+        response.content_length = len(CLIENTRAW_BODY)
+        await response.prepare(request)
+        await response.write(CLIENTRAW_BODY[:10])
+        await asyncio.sleep(5)
+        return response
+
+    app = web.Application()
+    app.router.add_get('/clientraw.txt', clientraw)
+    app.router.add_get('/slow/clientraw.txt', slow)
+    server = TestServer(app, loop=loop)
+    loop.run_until_complete(server.start_server(loop=loop))
+    session = aiohttp.ClientSession(loop=loop)
+    monkeypatch.setattr(sensor, 'async_get_clientsession', lambda _: session)
+    monkeypatch.setattr(sensor, 'FETCH_TIMEOUT', 0.5)
+    yield server
+    loop.run_until_complete(session.close())
+    loop.run_until_complete(server.close())
+
+
+def fetch(loop, hass, url):
+    """Fetch clientraw.txt of a url once."""
+    weather = sensor.ClientrawData(hass, url, 1, [])
+    file = weather.files[sensor.CLIENTRAW]
+    return weather, file, loop.run_until_complete(
+        weather._async_fetch_http(file))
+
+
+def test_fetch_not_found(loop, hass, station):
+    """A 404 is a failed fetch."""
+    _, _, result = fetch(loop, hass, str(station.make_url('/missing.txt')))
+    assert result == (False, None)
+
+
+def test_fetch_not_modified(loop, hass, station):
+    """The ETag is sent once the body was applied."""
+    weather, file, result = fetch(
+        loop, hass, str(station.make_url('/clientraw.txt')))
+    assert result == (True, CLIENTRAW_BODY)
+    assert file.etag is None
+
+    file.commit(*file.parse(CLIENTRAW_BODY))
+    assert loop.run_until_complete(
+        weather._async_fetch_http(file)) == (True, None)
+
+
+def test_fetch_slow_body_times_out(loop, hass, station):
+    """A station stalling the body fails within the fetch timeout."""
+    start = loop.time()
+    _, _, result = fetch(
+        loop, hass, str(station.make_url('/slow/clientraw.txt')))
+
+    assert result == (False, None)
+    assert loop.time() - start < 2
+
+
+def test_diagnostic_counters_written_on_streak_edges(monkeypatch):
+    """Failure counters are throttled except when a streak starts or ends."""
+    now = [1000.0]
+    monkeypatch.setattr(sensor.time, 'monotonic', lambda: now[0])
+    poller = types.SimpleNamespace(failures=0, retries=0)
+    diagnostic = sensor.ClientrawDiagnosticSensor('retries', 'station')
+    diagnostic.weather = types.SimpleNamespace(poller=poller)
+    diagnostic.hass = object()
+    written = []
+    diagnostic.async_write_ha_state = lambda: written.append(
+        diagnostic.state)
+
+    for second in range(10):
+        now[0] += 1
+        poller.failures += 1
+        poller.retries += 1
+        diagnostic.async_update_from_weather()
+    now[0] += 1
+    poller.failures = 0
+    diagnostic.async_update_from_weather()
+
+    assert written == [1, 10]
+
+
+def test_windows_skip_nan_history_fields(hass):
+    """NaN samples restored from history don't poison the windows."""
+    weather = sensor.ClientrawData(
+        hass, '/tmp/clientraw.txt', 1,
+        [sensor.ClientrawSensor(True, 'wind_speed_10min_avg', 'station')])
+    fields = [0.0] * 120
+    fields[1] = float('nan')
+    weather._add_to_windows(0, fields)
+    fields[1] = 10.0
+    weather._add_to_windows(1, fields)
+
+    assert weather._window_values() == {
+        (sensor.WINDOW, 'mean', 1, 600): 10.0}